@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Production front end for main.py's app. Requests are accepted by an ASGI server, and each is handed to a
+# bounded pool of threads to run against sqlite, so one slow page only ties up one thread. Requests which
+# can't get a thread quickly enough are turned away with a 503 rather than left to pile up.
+# Run with `python3 asgi.py`, which needs uvicorn, or point any other ASGI server at asgi:application
+
+import asyncio, io, json, sys
+from concurrent.futures import ThreadPoolExecutor
+
+from main import app, config
+
+BUSY = json.dumps({"success": False, "message": "Server busy, try again shortly"}).encode()
+
+class Server():
+    def __init__(self, wsgi, threads=8, max_queue=64, queue_timeout=5):
+        self.wsgi = wsgi
+        self.threads = threads
+        # Requests allowed to wait for a thread at once, and for how many seconds
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.executor = ThreadPoolExecutor(threads)
+        self.slots = None
+        self.waiting = 0
+        self.shed = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        if self.slots is None:
+            # Made here so it belongs to the server's event loop
+            self.slots = asyncio.Semaphore(self.threads)
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        if self.waiting >= self.max_queue:
+            return await self.reject(send)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            return await self.reject(send)
+        finally:
+            self.waiting -= 1
+        try:
+            # The running loop, as inside a coroutine get_event_loop() always gives it. get_running_loop() needs 3.7
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self.executor, self.run, scope, body, send, loop)
+        finally:
+            self.slots.release()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def reject(self, send):
+        self.shed += 1
+        await send({"type": "http.response.start", "status": 503,
+            "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1")]})
+        await send({"type": "http.response.body", "body": BUSY})
+
+    def run(self, scope, body, send, loop):
+        # On a pool thread. The response is passed back to the event loop a chunk at a time, so streamed
+        # responses stay streamed
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(a.lower().encode("latin-1"), b.encode("latin-1")) for a,b in headers]
+
+        def start():
+            emit({"type": "http.response.start", "status": response["status"], "headers": response["headers"]})
+
+        result = self.wsgi(environ(scope, body), start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    start()
+                    started = True
+                emit({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not started:
+                start()
+            emit({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+def environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    ret = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": (scope.get("client") or ("",))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name, value = name.decode("latin-1"), value.decode("latin-1")
+        if name == "content-type":
+            key = "CONTENT_TYPE"
+        elif name == "content-length":
+            key = "CONTENT_LENGTH"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        ret[key] = ret[key] + "," + value if key in ret else value
+    return ret
+
+settings = dict(config.get("server", {}))
+workers = settings.pop("workers", 1)
+application = Server(app, **settings)
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("asgi.py is run with uvicorn (pip install uvicorn), or point another ASGI server at asgi:application")
+    uvicorn.run("asgi:application", host=config["host"], port=config["port"], workers=workers)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Times parse_cif.py importing, then updating, synthetic extracts of a few sizes, and main.py answering
+# schedule, summary and location requests against each, through Flask's test client. Results can be written
+# out as JSON and compared against an earlier run's, to catch regressions
+
+import argparse, datetime, json, math, os, platform, random, shutil, sqlite3, subprocess, sys, tempfile, time
+from collections import OrderedDict
+
+import synth_cif
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+START = datetime.date(2018, 5, 20)
+# A Monday, within the calendar parse_cif builds and after the update's changes
+DATE = START + datetime.timedelta(days=1)
+
+# The response cache is off so every request is answered from schedule.db
+CONFIG = {"host": "127.0.0.1", "port": 8081, "debug": False, "cache": {"max_entries": 0}}
+
+ENDPOINTS = ["schedule", "summaries", "location"]
+
+def percentile(ordered, fraction):
+    # Nearest rank
+    return ordered[max(0, math.ceil(fraction*len(ordered))-1)]
+
+def latencies(times, errors):
+    times = sorted(times)
+    return OrderedDict([
+        ("requests", len(times)),
+        ("errors", errors),
+        ("mean_ms", 1000*sum(times)/len(times)),
+        ("p50_ms", 1000*percentile(times, 0.5)),
+        ("p90_ms", 1000*percentile(times, 0.9)),
+        ("p99_ms", 1000*percentile(times, 0.99)),
+        ("max_ms", 1000*times[-1]),
+        ])
+
+def run_import(directory, extract, jobs):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(HERE, "parse_cif.py"), "--bulk", "--jobs", str(jobs), extract],
+        cwd=directory, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - started
+
+# Read from the working directory by parse_cif.py and main.py, as is config.json
+SHARED = ["codes", "images.json"]
+
+def prepare(directory):
+    os.makedirs(directory)
+    for name in SHARED:
+        os.symlink(os.path.join(HERE, name), os.path.join(directory, name))
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        json.dump(CONFIG, f)
+
+def targets(path, count, seed):
+    # The uids and locations requests are made for, picked from what's running on DATE
+    r = random.Random(seed)
+    conn = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+    uids = sorted(a for a, in conn.execute("SELECT `uid` FROM `calendar` WHERE `date`==?;", (DATE.isoformat(),)))
+    crs = sorted(a for a, in conn.execute("SELECT DISTINCT `crs` FROM `codes` WHERE `crs` IS NOT NULL AND `tiploc` IN (SELECT `tiploc` FROM `locations`);"))
+    conn.close()
+    return [r.choice(uids) for _ in range(count)], [r.choice(crs) for _ in range(count)], uids
+
+def run_endpoints(requests, warmup, seed, batch):
+    import main
+    uids, crs, running = targets("schedule.db", requests, seed)
+    r = random.Random(seed)
+    date = DATE.isoformat()
+    urls = {
+        "schedule": ["/json/schedule/%s/%s" % (a, date) for a in uids],
+        "summaries": ["/json/summaries/%s?uids=%s" % (date, "+".join(r.sample(running, min(batch, len(running))))) for _ in range(requests)],
+        "location": ["/location/%s/%s" % (a, date) for a in crs],
+        }
+    client = main.app.test_client()
+    out = OrderedDict()
+    for name in ENDPOINTS:
+        for url in urls[name][:warmup]:
+            client.get(url).data
+        times, errors = [], 0
+        for url in urls[name]:
+            started = time.perf_counter()
+            response = client.get(url)
+            response.data
+            times.append(time.perf_counter() - started)
+            errors += response.status_code != 200
+        out[name] = latencies(times, errors)
+    return out
+
+def bench_size(directory, schedules, args):
+    prepare(directory)
+    result = OrderedDict([("schedules", schedules)])
+    extract, update = os.path.join(directory, "sched.cif"), os.path.join(directory, "update.cif")
+
+    started = time.perf_counter()
+    result["records"] = synth_cif.write(extract, schedules, args.seed, START)
+    synth_cif.write(update, schedules, args.seed, START, update=True)
+    result["generate_s"] = time.perf_counter() - started
+
+    result["import_s"] = run_import(directory, extract, args.jobs)
+    result["import_records_per_s"] = result["records"]/result["import_s"]
+    result["database_bytes"] = os.path.getsize(os.path.join(directory, "schedule.db"))
+    result["update_s"] = run_import(directory, update, 1)
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        result["endpoints"] = run_endpoints(args.requests, args.warmup, args.seed, args.batch)
+    finally:
+        os.chdir(cwd)
+    return result
+
+def show(result):
+    print("%d schedules, %d records: generated in %.2fs, imported in %.2fs (%.0f records/s), %.1fMB, update applied in %.2fs" % (
+        result["schedules"], result["records"], result["generate_s"], result["import_s"], result["import_records_per_s"],
+        result["database_bytes"]/1e6, result["update_s"]))
+    for name, stats in result["endpoints"].items():
+        print("    %-10s %5d requests %3d errors  mean %7.2fms  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  max %7.2fms" % (
+            name, stats["requests"], stats["errors"], stats["mean_ms"], stats["p50_ms"], stats["p90_ms"], stats["p99_ms"], stats["max_ms"]))
+
+def compare(results, baseline, tolerance):
+    # Returns a line for each import time or median latency more than tolerance times the baseline's
+    previous = {a["schedules"]: a for a in baseline["sizes"]}
+    regressions = []
+    for result in results["sizes"]:
+        old = previous.get(result["schedules"])
+        if not old:
+            continue
+        pairs = [("import_s", result["import_s"], old["import_s"]), ("update_s", result["update_s"], old["update_s"])]
+        pairs += [(a + " p50_ms", result["endpoints"][a]["p50_ms"], old["endpoints"][a]["p50_ms"])
+            for a in result["endpoints"] if a in old["endpoints"]]
+        for name, new_value, old_value in pairs:
+            if new_value > old_value*tolerance:
+                regressions.append("%d schedules %s: %.3f, was %.3f" % (result["schedules"], name, new_value, old_value))
+    return regressions
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark importing and serving synthetic timetables")
+    parser.add_argument("--sizes", default="1000,5000,20000", help="comma separated numbers of schedules to try")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per endpoint and size")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed requests made first")
+    parser.add_argument("--batch", type=int, default=50, help="uids per summaries request")
+    parser.add_argument("--jobs", type=int, default=1, help="passed on to parse_cif.py")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write results here as JSON")
+    parser.add_argument("--baseline", help="compare against results from an earlier run, exiting 1 if any regressed")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="how many times slower than the baseline counts as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the generated extracts and databases")
+    args = parser.parse_args()
+
+    try:
+        sizes = [int(a) for a in args.sizes.split(",")]
+    except ValueError:
+        sys.exit("--sizes must be numbers separated by commas")
+
+    results = OrderedDict([
+        ("created", datetime.datetime.now().replace(microsecond=0).isoformat()),
+        ("commit", commit()),
+        ("python", platform.python_version()),
+        ("sqlite", sqlite3.sqlite_version),
+        ("requests", args.requests),
+        ("seed", args.seed),
+        ("sizes", []),
+        ])
+    root = tempfile.mkdtemp(prefix="eagle-bench-")
+    try:
+        for schedules in sizes:
+            result = bench_size(os.path.join(root, str(schedules)), schedules, args)
+            show(result)
+            results["sizes"].append(result)
+    finally:
+        if args.keep:
+            print("Extracts and databases kept in %s" % root)
+        else:
+            shutil.rmtree(root)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("Regressed: " + line)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Compares parse_cif's generated record decoders against the interpretive r2d loop
+
+import argparse, os, random, sys, tempfile, time
+
+import parse_cif
+
+def record(*fields):
+    return "".join(str(value).ljust(width)[:width] for value, width in fields)
+
+def synthetic_records(schedules, seed=0):
+    r = random.Random(seed)
+    tiplocs = sorted(parse_cif.TIPLOC)
+    for i in range(schedules):
+        minute = r.randrange(1440)
+        def hhmm(half=False):
+            return "%02d%02d%s" % (minute//60%24, minute%60, "H" if half else " ")
+        yield record(("BS", 2), ("N", 1), ("C%05d" % i, 6), ("180520", 6), ("181208", 6), ("1111100", 7), (" ", 1),
+            ("P", 1), ("OO", 2), ("2A%02d" % (i%100), 4), ("", 4), ("1", 1), ("21234001", 8), ("", 1), ("EMU", 3),
+            ("350", 4), ("100", 3), ("D", 6), ("S", 1), ("", 1), ("", 1), ("", 1), ("", 4), ("", 4), ("", 1), ("P", 1))
+        yield record(("BX", 2), ("", 4), ("", 5), ("LM", 2), ("Y", 1), ("", 66))
+        calls = r.sample(tiplocs, r.randint(2, 30))
+        yield record(("LO", 2), (calls[0], 7), ("", 1), (hhmm(), 5), (hhmm()[:4], 4), ("1", 3), ("FL", 3), ("", 4),
+            ("TB", 12), ("", 39))
+        for tiploc in calls[1:-1]:
+            minute += r.randint(1, 10)
+            if r.random() < 0.4:
+                yield record(("LI", 2), (tiploc, 7), ("", 1), ("", 10), (hhmm(True), 5), ("00000000", 8), ("", 6),
+                    ("", 3), ("", 12), ("", 26))
+            else:
+                yield record(("LI", 2), (tiploc, 7), ("", 1), (hhmm(), 5), (hhmm(True), 5), ("", 5), (hhmm()[:4], 4),
+                    (hhmm()[:4], 4), (str(r.randint(1, 12)), 3), ("", 3), ("", 3), ("T", 12), ("", 26))
+        minute += r.randint(1, 10)
+        yield record(("LT", 2), (calls[-1], 7), ("", 1), (hhmm(), 5), (hhmm()[:4], 4), ("2", 3), ("", 3), ("TF", 12),
+            ("", 43))
+    yield record(("ZZ", 2), ("", 78))
+
+def as_decoded(record_type, res):
+    # r2d output rearranged to match what the generated decoder returns
+    fields = parse_cif.DECODED_FIELDS.get(record_type)
+    if not fields:
+        return tuple(res)
+    return tuple(None if parse_cif.NULL_VALUES.get(a) == res[a] else res[a] for a in fields)
+
+def best_of(repeat, funct, records):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        funct(records)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run_r2d(records):
+    r2d = parse_cif.r2d
+    for record in records:
+        r2d(record)
+
+def run_decoders(records):
+    decoders = parse_cif.DECODERS
+    for record in records:
+        decoders[record[:2]](record)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CIF record decoding")
+    parser.add_argument("--schedules", type=int, default=20000, help="schedules in the synthetic file")
+    parser.add_argument("--file", help="benchmark against an existing CIF file, optionally gzipped, instead")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.file:
+        path = args.file
+    else:
+        f = tempfile.NamedTemporaryFile("w", suffix=".cif", delete=False)
+        with f:
+            for line in synthetic_records(args.schedules):
+                f.write(line + "\n")
+        path = f.name
+
+    # Plain or gzipped, as the importer takes them
+    with parse_cif.open_extract(path) as f:
+        records = list(parse_cif.read_records(f))
+    print()
+    if not args.file:
+        os.remove(path)
+
+    for record in records:
+        record_type, res = parse_cif.r2d(record)
+        if parse_cif.DECODERS[record_type](record) != as_decoded(record_type, res):
+            sys.exit("Decoders disagree on %r" % record)
+
+    results = []
+    for name, funct in [("r2d", run_r2d), ("decoders", run_decoders)]:
+        elapsed = best_of(args.repeat, funct, records)
+        results.append(elapsed)
+        print("%-10s %9d records %8.3fs %12.0f records/s" % (name, len(records), elapsed, len(records)/elapsed))
+    print("speedup    %.1fx" % (results[0]/results[1]))
+
+if __name__ == "__main__":
+    main()
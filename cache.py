@@ -0,0 +1,90 @@
+import sqlite3, threading, time
+from collections import OrderedDict, Counter
+
+# Puts between clearing expired responses out of the sqlite file
+PURGE_EVERY = 100
+
+class Cache():
+    # Finished responses, keyed by request. An in-process LRU, optionally backed by a sqlite file which several
+    # server processes can share. Everything is thrown away once schedule.db changes, which generation() tells us
+    def __init__(self, generation, max_entries=1024, ttl=300, path=None):
+        self.generation = generation
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.current = None
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.disk = None
+        if path:
+            self.disk = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+            self.disk.execute("PRAGMA journal_mode=WAL;")
+            self.disk.execute("CREATE TABLE IF NOT EXISTS responses(key TEXT PRIMARY KEY, generation TEXT, expires REAL, value BLOB, status INTEGER, mimetype TEXT);")
+            self.disk.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses(expires);")
+
+    def check_generation(self):
+        generation = repr(self.generation())
+        if generation != self.current:
+            if self.current is not None:
+                self.counts["invalidations"] += 1
+            self.entries.clear()
+            if self.disk:
+                self.disk.execute("DELETE FROM responses WHERE generation!=?;", (generation,))
+            self.current = generation
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            self.check_generation()
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.counts["hits"] += 1
+                return entry[1]
+            if entry:
+                del self.entries[key]
+                self.counts["expired"] += 1
+            if self.disk:
+                row = self.disk.execute("SELECT expires, value, status, mimetype FROM responses WHERE key==? AND generation==? AND expires>?;",
+                    (key, self.current, now)).fetchone()
+                if row:
+                    self.counts["disk_hits"] += 1
+                    self.remember(key, row[0], tuple(row[1:]))
+                    return row[1:]
+            self.counts["misses"] += 1
+            return None
+
+    def put(self, key, value, generation=None):
+        # generation, if given, is what schedule.db was when the response was started. One built from a
+        # database which has changed since isn't kept
+        now = time.time()
+        with self.lock:
+            self.check_generation()
+            if generation is not None and repr(generation) != self.current:
+                return
+            self.remember(key, now + self.ttl, value)
+            if self.disk:
+                self.disk.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?);", (key, self.current, now + self.ttl) + tuple(value))
+                # Bounded like the memory tier, dropping whatever expires soonest. Other processes add to the
+                # same file, so expired responses are cleared out every so often as well
+                self.disk.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY expires DESC LIMIT -1 OFFSET ?);",
+                    (self.max_entries,))
+                self.counts["puts"] += 1
+                if self.counts["puts"] % PURGE_EVERY == 0:
+                    self.disk.execute("DELETE FROM responses WHERE expires<=?;", (now,))
+
+    def remember(self, key, expires, value):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counts["evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            ret = OrderedDict((a, self.counts[a]) for a in ["hits", "disk_hits", "misses", "expired", "evictions", "invalidations"])
+            ret["entries"] = len(self.entries)
+            ret["max_entries"] = self.max_entries
+            ret["ttl"] = self.ttl
+            ret["disk"] = bool(self.disk)
+        return ret
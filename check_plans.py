@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Runs EXPLAIN QUERY PLAN over every query in queries.py and fails if any of them scans a whole table
+# or index. Checks an empty database built from parse_cif.py's schema, or an existing schedule.db if
+# one is given, since ANALYZE statistics can change the planner's mind
+
+import argparse, sqlite3, sys
+
+import parse_cif, queries
+
+# Representative parameters for each query. A list fills in a query's {0} placeholders, and is bound
+# once for each {0}
+PARAMETERS = {
+    "SCHEDULES_FOR_UID": ("C12345", "2018-05-21"),
+    "LOCATIONS_FOR_IID": (1,),
+    "ENDPOINTS_FOR_IID": (1,),
+    "ASSOCIATIONS_FOR_UID": ("C12345", "C12345", "2018-05-21"),
+    "CODES_BY_STANOX": ("87219",),
+    "CODES_BY_CRS": ("CLJ",),
+    "CODES_BY_TIPLOC": ("CLPHMJC",),
+    "SCHEDULES_CALLING_AT": (["CLPHMJC", "CLPHMJM"], "2018-05-21", "1______", "2018-05-21"),
+    "SCHEDULES_FOR_UIDS": (["C12345", "C23456"], "2018-05-21"),
+    "SCHEDULES_FOR_IIDS": ([1, 2, 3],),
+    "LOCATIONS_FOR_IIDS": ([1, 2, 3],),
+    "ASSOCIATIONS_FOR_UIDS": (["C12345", "C23456"], "2018-05-21"),
+    "CALENDAR_SCHEDULE": ("2018-05-21", "C12345"),
+    "CALENDAR_SCHEDULES": ("2018-05-21", ["C12345", "C23456"]),
+    "CALENDAR_CALLING_AT": ("2018-05-21", ["CLPHMJC", "CLPHMJM"]),
+    "CALENDAR_DEPARTURES": ("2018-05-21", ["CLPHMJC", "CLPHMJM"], 960, 1080, -1, -1, -1, 10),
+    "EXPORT_SCHEDULES": ("2018-05-21",),
+    "EXPORT_LOCATIONS": ("2018-05-21",),
+}
+
+# Queries which are meant to read a whole table: small ones, exports of days the calendar doesn't cover, and
+# what journey.py reads to build a day's timetable
+WHOLE_TABLES = {"CALENDAR_DATES", "EXPORT_SCHEDULES_RESOLVED", "EXPORT_LOCATIONS_RESOLVED", "ASSOCIATIONS_ON"}
+
+def bind(query, parameters):
+    bound = []
+    for parameter in parameters:
+        if isinstance(parameter, list):
+            bound.extend(parameter*query.count("{0}"))
+            query = query.format(",".join("?"*len(parameter)))
+        else:
+            bound.append(parameter)
+    return query, bound
+
+def empty_database():
+    conn = sqlite3.connect(":memory:")
+    for statement in parse_cif.SCHEMA + parse_cif.INDEXES:
+        conn.execute(statement)
+    return conn
+
+def full_scans(conn, query, parameters):
+    query, parameters = bind(query, parameters)
+    plan = conn.execute("EXPLAIN QUERY PLAN " + query, parameters).fetchall()
+    details = [row[-1] for row in plan]
+    # "SCAN x" is a full table scan, "SCAN x USING INDEX" a full index scan. Both mean a missing index
+    return details, [a for a in details if a.startswith("SCAN ") and a != "SCAN CONSTANT ROW"]
+
+def check(conn, verbose=False):
+    failures = 0
+    for name in sorted(PARAMETERS):
+        details, scans = full_scans(conn, getattr(queries, name), PARAMETERS[name])
+        print("%-24s %s" % (name, "FULL SCAN" if scans else "ok"))
+        if scans or verbose:
+            for detail in details:
+                print("    " + detail)
+        failures += bool(scans)
+    missing = sorted(a for a in dir(queries) if a.isupper() and a not in PARAMETERS and a not in WHOLE_TABLES)
+    for name in missing:
+        print("%-24s no parameters to check it with" % name)
+    return failures + len(missing)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that no query in queries.py scans a whole table")
+    parser.add_argument("database", nargs="?", help="check against this database instead of an empty one")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show every plan")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect("file:%s?mode=ro" % args.database, uri=True) if args.database else empty_database()
+    if check(conn, args.verbose):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Checks that tops.infer's indexed lookup picks the same rule as checking every rule in turn would, for
+# every combination of fields found in schedule.db, and for every combination of the values the rules use
+
+import argparse, itertools, sqlite3, sys
+
+import tops
+
+FIELDS = ["atoc_code", "power_type", "speed", "timing_load", "seating_class"]
+
+def from_database(path):
+    conn = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+    return conn.execute("SELECT DISTINCT %s FROM schedules;" % ",".join(FIELDS)).fetchall()
+
+def from_rules():
+    # Each field takes each value any rule looks for, plus nothing and something no rule looks for
+    values = [sorted({a[0][n] for a in tops.TOPS_INFERENCES if a[0][n]}) + [None, "???"] for n in range(len(FIELDS))]
+    return itertools.product(*values)
+
+def check(keys, verbose=False):
+    checked, failures = 0, 0
+    for key in keys:
+        key = tuple(key)
+        expected, got = tops.scan(key), tops.lookup(key)
+        checked += 1
+        if expected != got:
+            failures += 1
+            print("%s: rule %s expected, rule %s given" % (key, expected, got))
+        elif verbose:
+            print("%s: rule %s" % (key, got))
+    return checked, failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Check tops.infer's index against a scan of every rule")
+    parser.add_argument("database", nargs="?", default="schedule.db", help="take combinations from this database")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show every combination checked")
+    args = parser.parse_args()
+
+    failures = 0
+    for name, keys in [("schedule.db", from_database(args.database)), ("rules", from_rules())]:
+        checked, failed = check(keys, args.verbose)
+        print("%-12s %7d combinations, %d mismatched" % (name, checked, failed))
+        failures += failed
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import functools, os, queue, sqlite3, time
+
+def timed(method):
+    # Counts the time a cursor method spends in sqlite towards the statement it's running
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        timer = self.connection.timer
+        if timer is None or self.statement is None:
+            return method(self, *args)
+        started = time.perf_counter()
+        timer.enter("sql")
+        try:
+            return method(self, *args)
+        finally:
+            timer.exit()
+            self.statement[2] += time.perf_counter() - started
+    return wrapper
+
+class TimedCursor(sqlite3.Cursor):
+    # Handed out while a request is being timed, recording each statement it runs with the request's timer
+    statement = None
+
+    def execute(self, sql, parameters=()):
+        if self.connection.timer is not None:
+            self.statement = self.connection.timer.statement(sql, parameters)
+        return self.timed_execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        if self.connection.timer is not None:
+            self.statement = self.connection.timer.statement(sql, ())
+        return self.timed_executemany(sql, parameters)
+
+    timed_execute = timed(sqlite3.Cursor.execute)
+    timed_executemany = timed(sqlite3.Cursor.executemany)
+    fetchone = timed(sqlite3.Cursor.fetchone)
+    fetchmany = timed(sqlite3.Cursor.fetchmany)
+    fetchall = timed(sqlite3.Cursor.fetchall)
+    __next__ = timed(sqlite3.Cursor.__next__)
+
+class Connection(sqlite3.Connection):
+    # The schedule.db generation this connection was opened against
+    generation = None
+    # (pool version, dates covered by the precomputed calendar), read on first use
+    calendar = None
+    # metrics.Timer of the request using this connection, while instrumentation is on
+    timer = None
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = sqlite3.Cursor if self.timer is None else TimedCursor
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, parameters=()):
+        # sqlite3's own doesn't go through cursor()
+        return self.cursor().execute(sql, parameters)
+
+class ConnectionPool():
+    # Read-only connections to schedule.db, handed out one per request and reused afterwards. Connections
+    # to a database which parse_cif.py has since replaced are closed rather than reused
+    def __init__(self, path="schedule.db", pool_size=8, mmap_size=256*1024*1024, immutable=False, timeout=10):
+        self.path = path
+        self.mmap_size = mmap_size
+        # immutable skips locking altogether, which is only safe if update extracts are never applied in place
+        self.uri = "file:%s?mode=ro%s" % (path, "&immutable=1" if immutable else "")
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(pool_size)
+
+    def generation(self):
+        # Full imports rename a new file over schedule.db, so a different inode means a new import.
+        # Update extracts are applied in place, and open connections see them without reopening
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def version(self):
+        # Unlike generation(), this also changes when an update extract is applied in place
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def connect(self):
+        generation = self.generation()
+        conn = sqlite3.connect(self.uri, uri=True, timeout=self.timeout, check_same_thread=False, factory=Connection)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=ON;")
+        conn.execute("PRAGMA mmap_size=%d;" % self.mmap_size)
+        conn.generation = generation
+        return conn
+
+    def get(self):
+        generation = self.generation()
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if conn.generation == generation:
+                return conn
+            conn.close()
+
+    def put(self, conn):
+        conn.timer = None
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+# Writes out every schedule running on a date as newline delimited JSON, one schedule per line, the same as
+# /json/export gives
+
+import argparse, datetime, sys
+
+from main import app, export_lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a day's timetable from schedule.db as newline delimited JSON")
+    parser.add_argument("date", nargs="?", default=datetime.date.today().isoformat(), help="YYYY-MM-DD, today by default")
+    parser.add_argument("-o", "--output", help="write to this file rather than stdout")
+    args = parser.parse_args()
+
+    try:
+        date = datetime.datetime.strptime(args.date, "%Y-%m-%d").date()
+    except ValueError:
+        sys.exit("Dates must be valid and in ISO 8601 format (YYYY-MM-DD)")
+
+    f = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        with app.app_context():
+            for line in export_lines(date):
+                f.write(line)
+    finally:
+        if args.output:
+            f.close()
+
+if __name__ == "__main__":
+    main()
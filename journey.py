@@ -0,0 +1,166 @@
+# Journey planning with the connection scan algorithm. A Timetable holds every hop between advertised stops made
+# by trains running on one date, sorted by departure, in flat arrays. Searches then run entirely in memory,
+# so a timetable is built once per date and kept for as many searches as want it
+
+import bisect
+from array import array
+from collections import OrderedDict
+
+import queries
+
+NEVER = 1 << 30
+
+def minutes(time):
+    return int(time[:2])*60 + int(time[2:4])
+
+def hhmm(minutes):
+    # Times after midnight stay after midnight, so 0010 the next morning is 2410
+    return "%02d%02d" % divmod(minutes, 60)
+
+class Timetable():
+    def __init__(self, conn, date, use_calendar=True):
+        self.date = date
+        # Stations are their CRS where they have one, so changing between TIPLOCs at the same station works
+        self.stops, self.stop_ids, self.stop_for_tiploc = [], {}, {}
+        self.trips = []
+        # One entry per connection: departure and arrival in minutes past midnight, the stops between, the trip
+        # and the seq it departs from, and whether passengers may board at the start and alight at the end
+        self.departures, self.arrivals = array("l"), array("l")
+        self.origins, self.destinations = array("l"), array("l")
+        self.trip, self.seq = array("l"), array("l")
+        self.boards, self.alights = array("b"), array("b")
+        # (trip, stop) -> [(trip, seq, departure)] for trains which carry on as another, through joins, divides and next workings
+        self.continuations = {}
+
+        if use_calendar:
+            parameters = (date.isoformat(),)
+            schedules, locations = queries.EXPORT_SCHEDULES, queries.EXPORT_LOCATIONS
+        else:
+            parameters = (date.isoformat(), date.weekday()+1)
+            schedules, locations = queries.EXPORT_SCHEDULES_RESOLVED, queries.EXPORT_LOCATIONS_RESOLVED
+        trip_ids, uids = {}, {}
+        for schedule in conn.execute(schedules, parameters):
+            trip_ids[schedule["iid"]] = uids[schedule["uid"]] = len(self.trips)
+            self.trips.append(schedule["uid"])
+        seqs = self.read_locations(conn.execute(locations, parameters), trip_ids)
+        self.read_associations(conn, date, uids, seqs)
+
+    def stop(self, location):
+        tiploc = location["tiploc"]
+        if tiploc not in self.stop_for_tiploc:
+            key = location["crs"] or tiploc
+            if key not in self.stop_ids:
+                self.stop_ids[key] = len(self.stops)
+                self.stops.append(OrderedDict([("crs", location["crs"]), ("name", location["name"]), ("tiplocs", [])]))
+            self.stop_for_tiploc[tiploc] = self.stop_ids[key]
+            self.stops[self.stop_ids[key]]["tiplocs"].append(tiploc)
+        return self.stop_for_tiploc[tiploc]
+
+    def read_locations(self, locations, trip_ids):
+        # Locations come in iid and seq order. Returns the seq and time of each trip's first call at each stop
+        seqs = {}
+        connections = []
+        last = None
+        for location in locations:
+            arrival, departure = location["arrival_public"], location["departure_public"]
+            if not (arrival or departure):
+                # Passing points, and stops which aren't advertised
+                continue
+            trip, stop = trip_ids[location["iid"]], self.stop(location)
+            time = minutes(arrival or departure)
+            if last and last[0] == trip:
+                while time < last[3]:
+                    time += 1440
+                connections.append((last[3], time, last[1], stop, trip, last[2], last[4], bool(arrival)))
+            if departure:
+                departure = minutes(departure)
+                while departure < time:
+                    departure += 1440
+            last = (trip, stop, location["seq"], departure or time, bool(departure))
+            seqs.setdefault((trip, stop), (location["seq"], last[3]))
+
+        connections.sort()
+        columns = [self.departures, self.arrivals, self.origins, self.destinations, self.trip, self.seq, self.boards, self.alights]
+        for connection in connections:
+            for column, value in zip(columns, connection):
+                column.append(value)
+        return seqs
+
+    def read_associations(self, conn, date, uids, seqs):
+        # Reduced as main.py's resolve_associations does, cancellations topmost. Only same day associations are
+        # any use within one date's timetable
+        current = OrderedDict()
+        for assoc in conn.execute(queries.ASSOCIATIONS_ON, (date.isoformat(),)):
+            if assoc["assoc_days"][date.weekday()] == "1":
+                current[(assoc["tiploc"], assoc["suffix"], assoc["category"], assoc["uid"], assoc["uid_assoc"])] = assoc
+        for assoc in current.values():
+            if assoc["stp"] == "C" or assoc["date_indicator"] != "S":
+                continue
+            # Passengers stay aboard from one train into the other: into the main train for a join, out of it otherwise
+            if assoc["category"] == "JJ":
+                before, after = assoc["uid_assoc"], assoc["uid"]
+            else:
+                before, after = assoc["uid"], assoc["uid_assoc"]
+            if before in uids and after in uids and assoc["tiploc"] in self.stop_for_tiploc:
+                stop = self.stop_for_tiploc[assoc["tiploc"]]
+                if (uids[after], stop) in seqs:
+                    seq, departure = seqs[(uids[after], stop)]
+                    self.continuations.setdefault((uids[before], stop), []).append((uids[after], seq, departure))
+
+    def search(self, origins, destinations, after, change=5):
+        # Earliest arrival at any of the destination stops, leaving any of the origins no earlier than after.
+        # Changing trains takes change minutes, staying aboard while one train becomes another doesn't.
+        # Returns [(trip, first connection, last connection, stayed aboard)], or None
+        reached = {a: after for a in origins}
+        arrived, via = {}, {}
+        boarded, entered, carried = {}, {}, {}
+        best, best_stop = NEVER, None
+        for n in range(bisect.bisect_left(self.departures, after), len(self.departures)):
+            departure = self.departures[n]
+            if departure >= best:
+                break
+            trip, seq = self.trip[n], self.seq[n]
+            if boarded.get(trip, NEVER) > seq:
+                if not self.boards[n] or reached.get(self.origins[n], NEVER) > departure:
+                    continue
+                boarded[trip] = seq
+            if trip not in entered:
+                entered[trip] = n
+            stop, arrival = self.destinations[n], self.arrivals[n]
+            if self.alights[n] and arrival < arrived.get(stop, NEVER):
+                arrived[stop], via[stop] = arrival, n
+                reached[stop] = min(reached.get(stop, NEVER), arrival + change)
+                if stop in destinations:
+                    best, best_stop = arrival, stop
+            for other, other_seq, other_departure in self.continuations.get((trip, stop), ()):
+                if other_departure >= arrival and boarded.get(other, NEVER) > other_seq:
+                    boarded[other] = other_seq
+                    carried[other] = n
+        if best_stop is None:
+            return None
+
+        legs = []
+        n = via[best_stop]
+        while len(legs) <= len(self.trips):
+            trip = self.trip[n]
+            legs.insert(0, (trip, entered[trip], n, trip in carried))
+            if trip in carried:
+                n = carried[trip]
+                continue
+            stop = self.origins[entered[trip]]
+            if stop in origins:
+                return legs
+            n = via[stop]
+        # Only reached if the legs somehow form a loop
+        return None
+
+    def describe(self, legs):
+        return [OrderedDict([
+            ("uid", self.trips[trip]),
+            ("from", self.stops[self.origins[first]]),
+            ("departure", hhmm(self.departures[first])),
+            ("to", self.stops[self.destinations[last]]),
+            ("arrival", hhmm(self.arrivals[last])),
+            # True where this train carries on from the one before, through a join, divide or next working
+            ("stay_aboard", stayed),
+            ]) for trip, first, last, stayed in legs]
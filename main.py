@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import sqlite3, json, datetime, os, math, re
+import sqlite3, json, datetime, os, math, re, functools, threading
 from collections import OrderedDict, defaultdict, Counter
 from datetime import timedelta
 
@@ -9,15 +9,27 @@ import flask, werkzeug
 from flask import Response
 from flask import request
 
-import tops
+import cache, database, journey, metrics, queries, reference, tops
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps(struct, pretty=False):
+    # orjson is considerably quicker where it's installed, but either gives the same JSON
+    if orjson:
+        return orjson.dumps(struct, option=orjson.OPT_INDENT_2 if pretty else 0)
+    return json.dumps(struct, indent=2 if pretty else None, separators=None if pretty else (",", ":"), ensure_ascii=False).encode()
 
 class UnauthenticatedException(Exception): pass
-AUTH_FAIL = Response(json.dumps({"success": False, "message":"Authentication failure"}, indent=2), mimetype="application/json", status=403)
+# Raised with a status code and a message
+class BadRequestException(Exception): pass
+AUTH_FAIL = Response(dumps({"success": False, "message":"Authentication failure"}), mimetype="application/json", status=403)
 
 DATE_PATTERN = re.compile(r"\d{4}-\d\d-\d\d")
 
-with open("codes/tiploc.json") as f:
-    TIPLOCS = json.load(f)
+TIPLOCS = reference.Tiplocs("codes/tiploc.json")
 
 with open("codes/tocs.json") as f:
     TOCS = json.load(f)
@@ -25,8 +37,10 @@ with open("codes/tocs.json") as f:
 with open("codes/activity.json") as f:
     ACTIVITY = json.load(f)
 
+# Code tables for disambiguate. tiploc.json is far bigger than the rest put together, and isn't one
 CODES = {}
 for name in os.listdir("codes"):
+    if name == "tiploc.json": continue
     with open("codes/%s" % name) as f:
         CODES[name.split(".")[0]] = json.load(f)
 
@@ -34,14 +48,45 @@ with open("config.json") as f:
     config = json.load(f)
 
 app = flask.Flask(__name__)
-_database = None
+pool = database.ConnectionPool('schedule.db', **config.get("database", {}))
+response_cache = cache.Cache(pool.version, **config.get("cache", {}))
+request_metrics = metrics.Metrics(**config.get("metrics", {}))
 
 def get_database():
-    global _database
-    if not _database:
-        _database = sqlite3.connect('schedule.db', check_same_thread=False)
-        _database.row_factory = sqlite3.Row
-    return _database
+    # Each request checks a connection out of the pool on first use, and gives it back on teardown
+    if "database" not in flask.g:
+        flask.g.database = pool.get()
+        flask.g.database.timer = flask.g.get("timer")
+    return flask.g.database
+
+class NotTimed():
+    # As contextlib.nullcontext, which needs Python 3.7
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+NOT_TIMED = NotTimed()
+
+def phase(name):
+    # Time spent inside counts towards name in the request's breakdown, while instrumentation is on
+    timer = flask.g.get("timer") if request_metrics.enabled else None
+    return timer.phase(name) if timer else NOT_TIMED
+
+def in_phase(name):
+    def decorator(funct):
+        @functools.wraps(funct)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return funct(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def unhandled():
+    # Routes turn anything unexpected into a plain 500, so it's logged here rather than lost
+    app.logger.exception("Unhandled exception answering %s", request.path)
+    request_metrics.exception(request.endpoint)
 
 def format(schedule, date, associations):
     global TIPLOCS, TOCS
@@ -49,15 +94,18 @@ def format(schedule, date, associations):
     metres = 0
     last_en = None
     for location in schedule["locations"]:
-        full = TIPLOCS[location["tiploc"]]
-        if full["loc_source"]:
-            if last_en:
-                metres += int(math.sqrt((last_en[0]-full["easting"])**2 + (last_en[1]-full["northing"])**2))
-            last_en = full["easting"], full["northing"]
-        location["distance"] = metres
-        location["distance_km"] = int(metres/1000)
+        # parse_cif.py works distances out at import, databases from before it did still need them calculating
+        if "distance" not in location:
+            full = TIPLOCS[location["tiploc"]]
+            if full.loc_source:
+                if last_en:
+                    metres += int(math.sqrt((last_en[0]-full.easting)**2 + (last_en[1]-full.northing)**2))
+                last_en = full.easting, full.northing
+            location["distance"] = metres
+        location["distance_km"] = int(location["distance"]/1000)
         
         del location["iid"], location["seq"]
+        location.pop("time_key", None)
         tiploc = location["tiploc"]
         location["activity_list"] = [a+b for a,b in list(zip(*[iter(location["activity"])]*2)) if (a+b).strip()]
         location["associations"] = associations.get((tiploc, location["tiploc_instance"]), [])
@@ -70,28 +118,198 @@ def format(schedule, date, associations):
 def weekday_pattern(date):
     return ''.join([(date.weekday()==a)*"1" or "_" for a in range(7)])
 
-def rowfor(uid, date, recurse=False):
-    c = get_database().cursor()
-    c.execute("SELECT * FROM `schedules` WHERE `uid`==? AND ? BETWEEN `valid_from` AND `valid_to` ORDER BY `stp` DESC;", (uid, date))
-    all = c.fetchall()
+def resolve(schedules, date):
+    # schedules for a single uid, in descending STP order. Later rows override earlier ones: cancellations
+    # beat overlays beat permanent schedules, provided they run on this weekday
     ret,schedule = None, None
-    for schedule in all:
+    for schedule in schedules:
         if schedule["running_days"][date.weekday()] == "1":
             ret = schedule
-    ret = ret or schedule
+    return ret or schedule
+
+@in_phase("build")
+def build(schedule, locations, date, associations):
+    ret = OrderedDict(schedule)
+    ret["operator_name"] = TOCS.get(ret["atoc_code"])
+    ret["weekday_match"] = ret["running_days"][date.weekday()] == "1"
+    ret["locations"] = [OrderedDict(a) for a in locations]
+    return format(OrderedDict(ret), date, associations)
+
+def calendar_dates():
+    # Dates parse_cif.py has already resolved overlays for. Update extracts move these on in place, so
+    # they're read again whenever schedule.db has changed since this connection last read them
+    conn = get_database()
+    version = pool.version()
+    if conn.calendar is None or conn.calendar[0] != version:
+        try:
+            conn.calendar = (version, {a[0] for a in conn.execute(queries.CALENDAR_DATES)})
+        except sqlite3.OperationalError:
+            # Imported before the calendar existed
+            conn.calendar = (version, set())
+    return conn.calendar[1]
+
+def current_schedule(uid, date):
+    c = get_database().cursor()
+    ret = None
+    if date.isoformat() in calendar_dates():
+        c.execute(queries.CALENDAR_SCHEDULE, (date.isoformat(), uid))
+        ret = c.fetchone()
+    # The calendar only holds schedules which run, anything else is resolved the long way
+    if not ret:
+        c.execute(queries.SCHEDULES_FOR_UID, (uid, date))
+        ret = resolve(c.fetchall(), date)
+    return ret
+
+def rowfor(uid, date, recurse=False):
+    c = get_database().cursor()
+    ret = current_schedule(uid, date)
     if ret:
-        ret = OrderedDict(ret)
-        ret["operator_name"] = TOCS.get(ret["atoc_code"])
-        ret["weekday_match"] = ret["running_days"][date.weekday()] == "1"
-        c.execute("SELECT codes.*,locations.* FROM locations LEFT JOIN codes ON locations.tiploc==codes.tiploc WHERE locations.iid==? ORDER BY locations.seq;", [ret["iid"],])
-        ret["locations"] = [OrderedDict(a) for a in c.fetchall()]
-        ret = format(OrderedDict(ret), date, associations(uid, date, recurse))
+        c.execute(queries.LOCATIONS_FOR_IID, [ret["iid"],])
+        ret = build(ret, c.fetchall(), date, associations(uid, date, recurse))
+    return ret
+
+def endpoints(uid, date):
+    # Origin and destination of the schedule rowfor would return, without building the rest of it. Trains
+    # which join and divide tend to be associated with each other several times over, so these are kept
+    # for the rest of the request
+    memo = flask.g.setdefault("endpoints", {})
+    if (uid, date) not in memo:
+        c = get_database().cursor()
+        schedule, ret = current_schedule(uid, date), None
+        if schedule:
+            try:
+                c.execute(queries.ENDPOINTS_FOR_IID, (schedule["iid"],))
+                ret = c.fetchone()
+            except sqlite3.OperationalError:
+                # Imported before endpoints were
+                c.execute(queries.LOCATIONS_FOR_IID, (schedule["iid"],))
+                locs = c.fetchall()
+                if locs:
+                    ret = {"origin_tiploc": locs[0]["tiploc"], "origin_name": locs[0]["name"], "origin_crs": locs[0]["crs"],
+                           "dest_tiploc": locs[-1]["tiploc"], "dest_name": locs[-1]["name"], "dest_crs": locs[-1]["crs"]}
+        memo[(uid, date)] = ret if ret and ret["origin_tiploc"] else None
+    return memo[(uid, date)]
+
+def chunks(values, size=500):
+    # Keeps IN (...) lists well inside sqlite's limit on bound parameters
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i+size]
+
+def build_many(current, date):
+    # Builds each of {uid: schedule row} as rowfor would, in a handful of queries rather than several per
+    # train. Returns {iid: schedule}
+    c = get_database().cursor()
+    locations = defaultdict(list)
+    for iids in chunks(a["iid"] for a in current.values()):
+        c.execute(queries.LOCATIONS_FOR_IIDS.format(",".join("?"*len(iids))), iids)
+        for location in c.fetchall():
+            locations[location["iid"]].append(location)
+
+    assocs = defaultdict(list)
+    for uids in chunks(current):
+        c.execute(queries.ASSOCIATIONS_FOR_UIDS.format(",".join("?"*len(uids))), uids + uids + [date])
+        for assoc in c.fetchall():
+            assocs[assoc["uid"]].append(assoc)
+            if assoc["uid_assoc"] != assoc["uid"]:
+                assocs[assoc["uid_assoc"]].append(assoc)
+
+    return OrderedDict((schedule["iid"], build(schedule, locations[schedule["iid"]], date, resolve_associations(uid, date, assocs[uid])))
+        for uid, schedule in current.items())
+
+def departures(tiplocs, date):
+    # Everything rowfor would build for each train calling at these TIPLOCs. Returns [(location, schedule)]
+    # in time order
+    c = get_database().cursor()
+    if date.isoformat() in calendar_dates():
+        c.execute(queries.CALENDAR_CALLING_AT.format(",".join("?"*len(tiplocs))), [date.isoformat()] + list(tiplocs))
+        current = OrderedDict((a["uid"], a) for a in c.fetchall())
+    else:
+        by_uid = OrderedDict()
+        c.execute(queries.SCHEDULES_CALLING_AT.format(",".join("?"*len(tiplocs))),
+            list(tiplocs) + [date.isoformat(), weekday_pattern(date), date.isoformat()])
+        for schedule in c.fetchall():
+            by_uid.setdefault(schedule["uid"], []).append(schedule)
+        current = OrderedDict((uid, resolve(schedules, date)) for uid, schedules in by_uid.items())
+    current = OrderedDict((uid, a) for uid, a in current.items() if a["running_days"][date.weekday()] == "1")
+
+    ret = []
+    for schedule in build_many(current, date).values():
+        for location in schedule["locations"]:
+            if location["tiploc"] in tiplocs:
+                ret.append((location, schedule))
+    ret.sort(key=lambda x: x[0]["departure"] or x[0]["arrival"] or x[0]["pass"])
     return ret
 
+def time_key(time):
+    # As parse_cif.py's, half minutes past midnight
+    return (int(time[:2])*60 + int(time[2:4]))*2 + (time[4:] == "H")
+
+def departures_page(tiplocs, date, start=0, end=2880, after=(-1, -1, -1), limit=None):
+    # Part of a board: calls from time_key start up to end, following the (time_key, iid, seq) given as after,
+    # and no more than limit of them. Returns [(location, schedule)] in that order, and what to pass as after
+    # for the next page, if there might be one
+    c = get_database().cursor()
+    rows = None
+    if date.isoformat() in calendar_dates():
+        try:
+            c.execute(queries.CALENDAR_DEPARTURES.format(",".join("?"*len(tiplocs))),
+                [date.isoformat()] + list(tiplocs) + [start, end] + list(after) + [-1 if limit is None else limit])
+            rows = [tuple(a) for a in c.fetchall()]
+        except sqlite3.OperationalError:
+            # Imported before time_key was
+            pass
+
+    if rows is None:
+        # Dates outside the calendar build the whole board, then cut it down
+        board = []
+        for location, schedule in departures(tiplocs, date):
+            seq = next(n for n,a in enumerate(schedule["locations"]) if a is location)
+            key = (time_key(location["departure"] or location["arrival"] or location["pass"]), schedule["iid"], seq)
+            if start <= key[0] < end and key > tuple(after):
+                board.append((key, location, schedule))
+        board.sort(key=lambda x: x[0])
+        board = board[:limit]
+        return [a[1:] for a in board], (board[-1][0] if limit and len(board) == limit else None)
+
+    current = OrderedDict()
+    for iids in chunks({a[0] for a in rows}):
+        c.execute(queries.SCHEDULES_FOR_IIDS.format(",".join("?"*len(iids))), iids)
+        current.update((a["uid"], a) for a in c.fetchall())
+    built = build_many(current, date)
+    board = [(built[iid]["locations"][seq], built[iid]) for iid, seq, key in rows]
+    return board, ((rows[-1][2],) + rows[-1][:2] if limit and len(rows) == limit else None)
+
+def summaries(uids, date):
+    # The schedule in force and its locations for each uid, in a few queries for the lot. Summaries don't
+    # show associations, so unlike rowfor this doesn't look any up. Returns {uid: (schedule, locations)}
+    c = get_database().cursor()
+    current = OrderedDict()
+    if date.isoformat() in calendar_dates():
+        for chunk in chunks(uids):
+            c.execute(queries.CALENDAR_SCHEDULES.format(",".join("?"*len(chunk))), [date.isoformat()] + chunk)
+            current.update((a["uid"], a) for a in c.fetchall())
+    for chunk in chunks(a for a in uids if a not in current):
+        by_uid = OrderedDict()
+        c.execute(queries.SCHEDULES_FOR_UIDS.format(",".join("?"*len(chunk))), chunk + [date.isoformat()])
+        for schedule in c.fetchall():
+            by_uid.setdefault(schedule["uid"], []).append(schedule)
+        current.update((uid, resolve(schedules, date)) for uid, schedules in by_uid.items())
+
+    locations = defaultdict(list)
+    for iids in chunks(a["iid"] for a in current.values()):
+        c.execute(queries.LOCATIONS_FOR_IIDS.format(",".join("?"*len(iids))), iids)
+        for location in c.fetchall():
+            locations[location["iid"]].append(location)
+    return {uid: (schedule, locations[schedule["iid"]]) for uid, schedule in current.items()}
+
 def associations(uid, date, recurse=False):
     c = get_database().cursor()
-    c.execute("SELECT * FROM `associations` WHERE (`uid`==? OR `uid_assoc`==?) AND ? BETWEEN `valid_from` AND `valid_to` ORDER BY `stp` DESC;", (uid, uid, date))
-    all = c.fetchall()
+    c.execute(queries.ASSOCIATIONS_FOR_UID, (uid, uid, date))
+    return resolve_associations(uid, date, c.fetchall(), recurse)
+
+@in_phase("associations")
+def resolve_associations(uid, date, all, recurse=False):
     all = [OrderedDict(a) for a in all]
     # Reduce with cancellations topmost, allowing for multiple categories per tiploc
     ret = OrderedDict()
@@ -121,19 +339,43 @@ def associations(uid, date, recurse=False):
                 date_rel += timedelta(days=1)
             if assoc["relative_indicator"]=="P":
                 date_rel += timedelta(days=-1)
-            assoc_sched = rowfor(assoc["uid_assoc"], date_rel, False)
-            if assoc_sched and assoc_sched["locations"]:
-                locs = assoc_sched["locations"]
-                first, last = locs[0], locs[-1]
-                assoc["direction"] = last["tiploc"]==assoc["tiploc"]
-                far = first if assoc["direction"] else last
-                assoc.update({"origin_name": first["name"], "origin_crs": first["crs"], "origin_tiploc": first["tiploc"],
-                             "dest_name": last["name"], "dest_crs": last["crs"], "dest_tiploc": last["tiploc"],
-                             "far_name": far["name"], "far_crs": far["crs"], "far_tiploc": far["tiploc"]
+            ends = endpoints(assoc["uid_assoc"], date_rel)
+            if ends:
+                assoc["direction"] = ends["dest_tiploc"]==assoc["tiploc"]
+                far = "origin" if assoc["direction"] else "dest"
+                assoc.update({"origin_name": ends["origin_name"], "origin_crs": ends["origin_crs"], "origin_tiploc": ends["origin_tiploc"],
+                             "dest_name": ends["dest_name"], "dest_crs": ends["dest_crs"], "dest_tiploc": ends["dest_tiploc"],
+                             "far_name": ends[far+"_name"], "far_crs": ends[far+"_crs"], "far_tiploc": ends[far+"_tiploc"]
                     })
         ret2[(assoc["tiploc"], assoc["suffix"])].append(assoc)
     return ret2
 
+def export(date):
+    # Every schedule running on a date, as /json/schedule would give each of them. Schedules and their
+    # locations are read from two cursors in iid order, so only one schedule is ever held at a time
+    conn = get_database()
+    if date.isoformat() in calendar_dates():
+        schedules = conn.execute(queries.EXPORT_SCHEDULES, (date.isoformat(),))
+        locations = conn.execute(queries.EXPORT_LOCATIONS, (date.isoformat(),))
+    else:
+        schedules = conn.execute(queries.EXPORT_SCHEDULES_RESOLVED, (date.isoformat(), date.weekday()+1))
+        locations = conn.execute(queries.EXPORT_LOCATIONS_RESOLVED, (date.isoformat(), date.weekday()+1))
+    location = next(locations, None)
+    for schedule in schedules:
+        locs = []
+        while location is not None and location["iid"] == schedule["iid"]:
+            locs.append(location)
+            location = next(locations, None)
+        yield schedule_struct(build(schedule, locs, date, associations(schedule["uid"], date, True)))
+
+def export_lines(date):
+    for struct in export(date):
+        yield dumps(struct) + b"\n"
+
+# Query parameters which authenticate a request. Cache keys leave them out, so nothing written into a
+# response may depend on them either, or one user's key could be served to the next
+CREDENTIALS = {"key"}
+
 def is_authenticated():
     key = request.args.get('key') or request.headers.get('x-eagle-key')
     if config.get("keys"):
@@ -145,7 +387,9 @@ def is_authenticated():
         return True
 
 def schedule_for(uid, date, recurse=False):
-        current = rowfor(uid, date, recurse)
+        return schedule_struct(rowfor(uid, date, recurse))
+
+def schedule_struct(current):
         struct = OrderedDict([
             ("success",True),
             ("message", "OK"),
@@ -153,11 +397,53 @@ def schedule_for(uid, date, recurse=False):
             ("tops_inferred", None),("tops_possible",[]),("tops_familiar",None),("tops_image",None),
             ("current",  current),
             ])
-        struct.update(tops.infer(current))
+        with phase("tops"):
+            struct.update(tops.infer(current))
         return struct
 
+def cached(route):
+    # Successful responses are reused until schedule.db changes or they're older than the cache's ttl.
+    # Failures are never cached, and neither is anything for unauthenticated requests. Nor are streamed
+    # responses, which would have to be read whole into memory first
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        if not response_cache.max_entries or not is_authenticated():
+            return route(*args, **kwargs)
+        key = repr((request.path, [a for a in request.args.items(multi=True) if a[0] not in CREDENTIALS]))
+        hit = response_cache.get(key)
+        if hit:
+            return Response(hit[0], status=hit[1], mimetype=hit[2])
+        version = pool.version()
+        response = flask.make_response(route(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            response_cache.put(key, (response.get_data(), response.status_code, response.mimetype), version)
+        return response
+    return wrapper
+
+def pretty():
+    # Compact unless asked otherwise, with ?pretty or ?pretty=1
+    return request.args.get("pretty", "0") not in ("0", "false")
+
+def json_response(struct, status=200):
+    with phase("render"):
+        return Response(dumps(struct, pretty()), mimetype="application/json", status=status)
+
+def render_template(name, **context):
+    with phase("render"):
+        return flask.render_template(name, **context)
+
+def stream_object(members):
+    # Writes out a JSON object a member at a time as (key, value) pairs are generated, rather than
+    # building the whole thing as one string first
+    yield b"{"
+    for n, (key, value) in enumerate(members):
+        with phase("render"):
+            out = (b"," if n else b"") + dumps(key) + b":" + dumps(value)
+        yield out
+    yield b"}"
+
 def error_page(code, message):
-    return flask.render_template('error.html', messages=["{0} - {1}".format(code, message)]), code
+    return render_template('error.html', messages=["{0} - {1}".format(code, message)]), code
 
 @app.route('/style')
 def style():
@@ -183,6 +469,7 @@ def disambiguate(type, code, multiple=False):
     return ret
 
 @app.route('/schedule/<path:path>/<path:date>')
+@cached
 def html_schedule(path, date):
     global ACTIVITY
 
@@ -195,7 +482,8 @@ def html_schedule(path, date):
         if not schedule:
             return error_page(404, "UID unknown, or date outside validity")
         else:
-            schedule.update(tops.infer(schedule))
+            with phase("tops"):
+                schedule.update(tops.infer(schedule))
             for location in schedule["locations"]:
                 location["activity_outlines"] = [ACTIVITY.get(a, {"classes": '', "summary": "unknown"}) for a in location["activity_list"]]
             if not schedule["weekday_match"]:
@@ -207,68 +495,128 @@ def html_schedule(path, date):
     except UnauthenticatedException as e:
         return error_page(403, "Unauthenticated")
     except Exception as e:
+        unhandled()
         return error_page(500, "Unhandled exception")
     return Response(
-        flask.render_template("schedule.html", schedule=schedule, half=half, disambiguate=disambiguate, notes=schedule_notes),
+        render_template("schedule.html", schedule=schedule, half=half, disambiguate=disambiguate, notes=schedule_notes),
         status=200,
         mimetype="text/html"
         )
 
+def board_window():
+    # ?from=HHMM&to=HHMM&limit=N&cursor=... for part of a board, or None for the whole day. from is inclusive,
+    # to isn't, and cursor is the next value given by the page before
+    args = request.args
+    if not any(a in args for a in ["from", "to", "limit", "cursor"]):
+        return None
+    try:
+        start, end = [time_key(args[a].replace(":", "")) if a in args else b for a,b in [("from", 0), ("to", 2880)]]
+        limit = int(args["limit"]) if "limit" in args else None
+        after = tuple(int(a) for a in args["cursor"].split(".")) if "cursor" in args else (-1, -1, -1)
+    except ValueError:
+        raise BadRequestException(400, "Times must be HHMM, and limit a number")
+    if len(after) != 3 or (limit is not None and limit < 1):
+        raise BadRequestException(400, "Invalid cursor or limit")
+    return start, end, after, limit
+
+def find_locations(code):
+    # The codes rows a STANOX, CRS or TIPLOC refers to
+    c = get_database().cursor()
+    if code.isnumeric() and len(code)==5: #STANOX
+        c.execute(queries.CODES_BY_STANOX, (code,))
+    elif code.isalpha() and len(code)==3: #CRS
+        c.execute(queries.CODES_BY_CRS, (code,))
+    elif code.isalnum() and len(code) in range(4,8): #TIPLOC, range 4..7
+        c.execute(queries.CODES_BY_TIPLOC, (code,))
+    else:
+        raise BadRequestException(400, "No valid location identifier provided.")
+
+    # All non-rail locations have a 00000 STANOX. Could be useful as a shortcut, but takes far too long to retrieve
+    if code=="00000" and not config.get("allow_null_stanox"):
+        raise BadRequestException(400, "STANOX 00000 disallowed.")
+
+    locations = c.fetchall()
+    if not locations:
+        raise BadRequestException(404, "No location found matching this identifier.")
+    return locations
+
+def location_board(code, date):
+    # Returns the locations code refers to, the (location, schedule) pairs for them, and the cursor for
+    # the next page if there is one
+    locations = find_locations(code)
+    tiplocs = [a["tiploc"] for a in locations]
+    window = board_window()
+    if window is None:
+        return locations, departures(tiplocs, date), None
+    board, after = departures_page(tiplocs, date, *window)
+    return locations, board, after and "%d.%d.%d" % after
+
 @app.route('/location/<code>/<date>')
+@cached
 def html_location(code, date):
     global config
+    later = None
     try:
         date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
         if not is_authenticated(): raise UnauthenticatedException()
-        c = get_database().cursor()
-        if code.isnumeric() and len(code)==5: #STANOX
-            c.execute("SELECT * FROM `codes` WHERE `stanox`==?;", (code,))
-        elif code.isalpha() and len(code)==3: #CRS
-            c.execute("SELECT * FROM `codes` WHERE `crs`==?;", (code,))
-        elif code.isalnum() and len(code) in range(4,8): #TIPLOC, range 4..7
-            c.execute("SELECT * FROM `codes` WHERE `tiploc`==?;", (code,))
-        else:
-            return error_page(400, "No valid location identifier provided.")
-
-        # All non-rail locations have a 00000 STANOX. Could be useful as a shortcut, but takes far too long to retrieve
-        if code=="00000" and not config.get("allow_null_stanox"):
-            return error_page(400, "STANOX 00000 disallowed.")
-
-        locations = c.fetchall()
-        tiplocs = [a["tiploc"] for a in locations]
-        if not locations:
-            return error_page(404, "No location found matching this identifier.")
-
-        schedules = []
-        for location in locations:
-            c.execute("SELECT DISTINCT schedules.uid from locations LEFT JOIN schedules ON locations.iid==schedules.iid WHERE locations.tiploc==? AND ? BETWEEN schedules.valid_from AND schedules.valid_to AND schedules.running_days LIKE '{0}' ORDER BY schedules.stp DESC;".format(weekday_pattern(date)), (location["tiploc"],date.isoformat()))
-            schedules.extend(c.fetchall())
-        schedules = [rowfor(a["uid"], date) for a in schedules]
-        departures = []
-        for schedule in schedules:
-            if not schedule or not schedule["weekday_match"]: continue
-            for location in schedule["locations"]:
-                if location["tiploc"] in tiplocs:
-                    location["activity_outlines"] = [ACTIVITY.get(a, {"classes": '', "summary": "unknown"}) for a in location["activity_list"]]
-                    departures.append((location, schedule))
-        departures.sort(key=lambda x: x[0]["departure"] or x[0]["arrival"] or x[0]["pass"])
+        locations, board, cursor = location_board(code, date)
+        for location, schedule in board:
+            location["activity_outlines"] = [ACTIVITY.get(a, {"classes": '', "summary": "unknown"}) for a in location["activity_list"]]
+        if cursor:
+            args = {a: b for a,b in request.args.items() if a not in CREDENTIALS}
+            later = flask.url_for("html_location", code=code, date=date.isoformat(), **dict(args, cursor=cursor))
+    except BadRequestException as e:
+        return error_page(*e.args)
     except ValueError as e:
         return error_page(400, "Invalid date format. Dates must be valid and in ISO 8601 format (YYYY-MM-DD)")
     except UnauthenticatedException as e:
         return error_page(403, "Unauthenticated")
     except Exception as e:
+        unhandled()
         return error_page(500, "Unhandled exception")
     return Response(
-        flask.render_template("location.html", schedules=departures, locations=locations, half=half, disambiguate=disambiguate, notes=[], code=code, date=date),
+        render_template("location.html", schedules=board, locations=locations, half=half, disambiguate=disambiguate, notes=[], code=code, date=date, later=later),
         status=200,
         mimetype="text/html"
         )
 
+def board_entry(location, schedule):
+    # A call on a board, with the train's details apart from the rest of its locations
+    ret = OrderedDict(location)
+    ret["schedule"] = OrderedDict((a,b) for a,b in schedule.items() if a != "locations")
+    for name, end in [("origin", schedule["locations"][0]), ("destination", schedule["locations"][-1])]:
+        ret[name] = OrderedDict((a, end[a]) for a in ["tiploc", "name", "crs"])
+    return ret
+
+@app.route('/json/location/<code>/<date>')
+@cached
+def json_location(code, date):
+    if not is_authenticated(): return AUTH_FAIL
+    try:
+        date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        locations, board, cursor = location_board(code, date)
+        return json_response(OrderedDict([
+            ("success", True),
+            ("message", "OK"),
+            ("locations", [OrderedDict(a) for a in locations]),
+            ("departures", [board_entry(*a) for a in board]),
+            ("cursor", cursor),
+            ]))
+    except BadRequestException as e:
+        status, failure_message = e.args
+    except ValueError as e:
+        status, failure_message = 400, "Invalid date format. Dates must be valid and in ISO 8601 format (YYYY-MM-DD)"
+    except Exception as e:
+        unhandled()
+        status, failure_message = 500, "Unhandled exception"
+    return json_response({"success": False, "message": failure_message}, status)
+
 @app.route('/r/<path:path>')
 def resource(path):
     return flask.send_from_directory("resources", path)
 
 @app.route('/json/schedule/<path:path>/<path:date>')
+@cached
 def json_schedule(path, date):
     if not is_authenticated(): return AUTH_FAIL
     failure_message = None
@@ -276,49 +624,193 @@ def json_schedule(path, date):
     try:
         date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
         struct = schedule_for(path, date, True)
-        return Response(json.dumps(struct, indent=2), mimetype="application/json", status=status)
+        return json_response(struct, status)
     except ValueError as e:
         status, failure_message = 400, "Invalid date format. Dates must be valid and in ISO 8601 format (YYYY-MM-DD)"
     except Exception as e:
+        unhandled()
         if not failure_message:
             status, failure_message = 500, "Unhandled exception"
-    return Response(json.dumps({"success": False, "message":failure_message}, indent=2), mimetype="application/json", status=status)
+    return json_response({"success": False, "message":failure_message}, status)
 
 @app.route('/json/summaries/<path:date>')
+@cached
 def json_summaries(date):
     global TIPLOC
     if not is_authenticated(): return AUTH_FAIL
     status, failure_message = 200, ""
     uids = request.args.get('uids', "")
     uids = uids.split(" ")
+    max_uids = config.get("max_summaries", 500)
+    if len(uids) > max_uids:
+        failure_message = "Too many uids, at most {0} may be requested at once".format(max_uids)
+        return json_response({"success": False, "message": failure_message}, 400)
     try:
         date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
-        out = OrderedDict()
-        for uid in uids:
-            current = rowfor(uid, date)
-            if not current:
-                out[uid] = {}
-            else:
-                try:
-                    out[uid] = OrderedDict([
-                        ("cancelled", current["stp"]=="C"),
-                        ("atoc_code", current["atoc_code"]),
-                        ("power_type", current["power_type"]),
-                        ("platforms", OrderedDict(
-                            [(a["crs"],a["platform"]) for a in current["locations"] if not a.get("pass") and a["crs"]]
-                            )),
-                        ])
-                except:
-                    out[uid] = {}
-                out[uid].update(tops.infer(current))
-        return Response(json.dumps(out, indent=2), mimetype="application/json", status=200)
+        uids = list(OrderedDict.fromkeys(uids))
+        found = summaries(uids, date)
+        if pretty():
+            return json_response(OrderedDict(summary_members(uids, found)))
+        # Kept in the request context while it's sent, so instrumentation times the whole of it
+        return Response(flask.stream_with_context(stream_object(summary_members(uids, found))), mimetype="application/json", status=200)
             
     except ValueError as e:
         status, failure_message = 400, "Invalid date format. Dates must be valid and in ISO 8601 format"
     except Exception as e:
+        unhandled()
         if not failure_message:
             status, failure_message = 500, "Unhandled exception"
-    return Response(json.dumps({"success": False, "message": failure_message}, indent=2), mimetype="application/json", status=status)
+    return json_response({"success": False, "message": failure_message}, status)
+
+def summary_members(uids, found):
+    for uid in uids:
+        current, locations = found.get(uid, (None, None))
+        if not current:
+            yield uid, {}
+            continue
+        try:
+            out = OrderedDict([
+                ("cancelled", current["stp"]=="C"),
+                ("atoc_code", current["atoc_code"]),
+                ("power_type", current["power_type"]),
+                ("platforms", OrderedDict(
+                    [(a["crs"],a["platform"]) for a in locations if not a["pass"] and a["crs"]]
+                    )),
+                ])
+        except:
+            out = {}
+        with phase("tops"):
+            out.update(tops.infer(current))
+        yield uid, out
+
+timetables = OrderedDict()
+timetables_lock = threading.Lock()
+# One lock per timetable being built, so requests for the same date wait for it rather than building it
+# again, while those for other dates carry on
+timetable_builds = {}
+
+def cached_timetable(key):
+    with timetables_lock:
+        if key in timetables:
+            timetables.move_to_end(key)
+            return timetables[key]
+
+def timetable(date):
+    # Journey planning timetables take a while to build, so the last few are kept until schedule.db changes
+    key = (date, pool.version())
+    tt = cached_timetable(key)
+    if tt:
+        return tt
+    with timetables_lock:
+        building = timetable_builds.setdefault(key, threading.Lock())
+    with building:
+        tt = cached_timetable(key)
+        if tt:
+            return tt
+        with phase("journey"):
+            tt = journey.Timetable(get_database(), date, date.isoformat() in calendar_dates())
+        with timetables_lock:
+            timetables[key] = tt
+            timetable_builds.pop(key, None)
+            while len(timetables) > max(1, config.get("journey", {}).get("timetables", 2)):
+                timetables.popitem(last=False)
+    return tt
+
+@app.route('/json/journey/<origin>/<destination>/<date>')
+@cached
+def json_journey(origin, destination, date):
+    if not is_authenticated(): return AUTH_FAIL
+    try:
+        date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        after, change = request.args.get("after", "0000").replace(":", ""), request.args.get("change", config.get("journey", {}).get("change", 5))
+        if not (after.isdigit() and len(after) == 4 and str(change).isdigit()):
+            raise BadRequestException(400, "after must be HHMM, and change a number of minutes")
+        tt = timetable(date)
+        ends = []
+        for code in origin, destination:
+            stops = {tt.stop_for_tiploc[a["tiploc"]] for a in find_locations(code) if a["tiploc"] in tt.stop_for_tiploc}
+            if not stops:
+                raise BadRequestException(404, "No trains call at {0} on this date".format(code))
+            ends.append(stops)
+        with phase("journey"):
+            legs = tt.search(ends[0], ends[1], journey.minutes(after), int(change))
+        if not legs:
+            raise BadRequestException(404, "No journey found")
+        legs = tt.describe(legs)
+        return json_response(OrderedDict([
+            ("success", True),
+            ("message", "OK"),
+            ("departure", legs[0]["departure"]),
+            ("arrival", legs[-1]["arrival"]),
+            ("legs", legs),
+            ]))
+    except BadRequestException as e:
+        status, failure_message = e.args
+    except ValueError as e:
+        status, failure_message = 400, "Invalid date format. Dates must be valid and in ISO 8601 format (YYYY-MM-DD)"
+    except Exception as e:
+        unhandled()
+        status, failure_message = 500, "Unhandled exception"
+    return json_response({"success": False, "message": failure_message}, status)
+
+@app.route('/json/export/<date>')
+def json_export(date):
+    if not is_authenticated(): return AUTH_FAIL
+    try:
+        date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+    except ValueError as e:
+        return json_response({"success": False, "message": "Invalid date format. Dates must be valid and in ISO 8601 format (YYYY-MM-DD)"}, 400)
+    # Newline delimited, one schedule per line. The request context, and its connection, last until it's all sent
+    return Response(flask.stream_with_context(export_lines(date)), mimetype="application/x-ndjson", status=200)
+
+@app.route('/json/cache')
+def json_cache():
+    if not is_authenticated(): return AUTH_FAIL
+    return json_response(response_cache.stats())
+
+@app.route('/metrics')
+def metrics_text():
+    if not is_authenticated(): return AUTH_FAIL
+    stats = response_cache.stats()
+    extra = [("eagle_cache_%s_total" % a, "counter", "Response cache %s" % a.replace("_", " "), stats[a])
+        for a in ["hits", "disk_hits", "misses", "expired", "evictions", "invalidations"]]
+    extra.append(("eagle_cache_entries", "gauge", "Responses held in memory", stats["entries"]))
+    return Response(request_metrics.render(extra), mimetype="text/plain; version=0.0.4")
+
+@app.before_request
+def start_timing():
+    if request_metrics.enabled:
+        flask.g.timer = metrics.Timer()
+        flask.g.profile = request_metrics.start_profile()
+
+@app.after_request
+def timing_header(response):
+    # The breakdown so far, for browsers' developer tools. Streamed responses are still being generated
+    timer = flask.g.get("timer")
+    if timer:
+        phases, total = timer.breakdown()
+        response.headers["Server-Timing"] = ", ".join("%s;dur=%.2f" % (a, b*1000) for a,b in sorted(phases.items()) + [("total", total)])
+        if response.is_streamed:
+            # The request is torn down before the body is generated, so it's recorded once the body is finished.
+            # The timer stays in g meanwhile, for the connection the generator checks out
+            flask.g.streaming = True
+            response.call_on_close(functools.partial(record_timing, timer, flask.g.get("profile"), request.endpoint, response.status_code))
+        else:
+            flask.g.status = response.status_code
+    return response
+
+def record_timing(timer, profile, endpoint, status):
+    if profile:
+        request_metrics.finish_profile(profile, endpoint)
+    request_metrics.observe(endpoint, status, timer)
+
+@app.teardown_request
+def finish_timing(exception):
+    if flask.g.get("streaming"):
+        return
+    timer = flask.g.pop("timer", None)
+    if timer:
+        record_timing(timer, flask.g.pop("profile", None), request.endpoint, flask.g.get("status", 500))
 
 @app.errorhandler(404)
 def page_not_found(e):
@@ -326,7 +818,7 @@ def page_not_found(e):
 
 @app.route('/')
 def index():
-    return flask.render_template('index.html')
+    return render_template('index.html')
 
 @app.route("/redirect/schedule")
 def redirect_schedule():
@@ -348,10 +840,9 @@ def redirect_location():
 
 @app.teardown_appcontext
 def close_connection(exception):
-    global _database
-    if _database:
-        pass
-        #_database.close()
+    conn = flask.g.pop("database", None)
+    if conn:
+        pool.put(conn)
 
 if __name__ == "__main__":
     app.run(config["host"], config["port"], config["debug"], ssl_context=None)
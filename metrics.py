@@ -0,0 +1,145 @@
+import bisect, contextlib, cProfile, logging, os, random, threading, time
+from collections import Counter, defaultdict
+
+# Upper bounds, in seconds, of the request duration histogram's buckets
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+class Timer():
+    # Splits one request's time between phases. Phases nest, and time counts towards whichever is innermost,
+    # so sqlite's time inside building a schedule isn't counted as building too. The rest is "other"
+    def __init__(self):
+        self.started = self.mark = time.perf_counter()
+        self.stack = ["other"]
+        self.phases = Counter()
+        # [sql, parameters, seconds] for each statement run, the seconds including fetching its rows
+        self.statements = []
+
+    def enter(self, name):
+        now = time.perf_counter()
+        self.phases[self.stack[-1]] += now - self.mark
+        self.mark = now
+        self.stack.append(name)
+
+    def exit(self):
+        now = time.perf_counter()
+        self.phases[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def statement(self, sql, parameters):
+        ret = [sql, parameters, 0.0]
+        self.statements.append(ret)
+        return ret
+
+    def breakdown(self):
+        # Seconds in each phase so far, and in all
+        now = time.perf_counter()
+        ret = Counter(self.phases)
+        ret[self.stack[-1]] += now - self.mark
+        return ret, now - self.started
+
+class Metrics():
+    # Totals across requests, by endpoint, for /metrics. Nothing is timed unless enabled is set
+    def __init__(self, enabled=False, slow_query_ms=100, slow_query_log=None, profile_rate=0, profile_dir="profiles"):
+        self.enabled = enabled
+        self.slow_query = slow_query_ms/1000 if slow_query_ms else None
+        # Fraction of requests run under cProfile, each written to profile_dir for pstats or snakeviz
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        # cProfile can't profile two requests at once, so one sampled while another is being profiled isn't
+        self.profiling = threading.Lock()
+        self.requests = Counter()
+        self.durations = defaultdict(lambda: [0]*(len(BUCKETS)+1))
+        self.duration_sums = Counter()
+        self.phases = Counter()
+        self.statement_counts = Counter()
+        self.statement_seconds = Counter()
+        self.exceptions = Counter()
+        self.counts = Counter()
+        self.log = logging.getLogger("eagle.slow_queries")
+        if slow_query_log:
+            self.log.addHandler(logging.FileHandler(slow_query_log))
+            self.log.propagate = False
+
+    def start_profile(self):
+        # A cProfile.Profile, already running, for the odd request which is sampled
+        if not self.profile_rate or random.random() >= self.profile_rate or not self.profiling.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish_profile(self, profile, endpoint):
+        endpoint = endpoint or "none"
+        profile.disable()
+        self.profiling.release()
+        with self.lock:
+            self.counts["profiles"] += 1
+            n = self.counts["profiles"]
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(self.profile_dir, "%s-%d-%d-%s.prof" % (time.strftime("%Y%m%dT%H%M%S"), os.getpid(), n, endpoint)))
+
+    def observe(self, endpoint, status, timer):
+        # endpoint is the name of the view, or None for paths which don't match one
+        endpoint = endpoint or "none"
+        phases, total = timer.breakdown()
+        slow = [a for a in timer.statements if self.slow_query and a[2] >= self.slow_query]
+        with self.lock:
+            self.requests[(endpoint, status)] += 1
+            self.durations[endpoint][bisect.bisect_left(BUCKETS, total)] += 1
+            self.duration_sums[endpoint] += total
+            for phase, seconds in phases.items():
+                self.phases[(endpoint, phase)] += seconds
+            self.statement_counts[endpoint] += len(timer.statements)
+            self.statement_seconds[endpoint] += sum(a[2] for a in timer.statements)
+            self.counts["slow_queries"] += len(slow)
+        for sql, parameters, seconds in slow:
+            self.log.warning("%.1fms in %s: %s %r", seconds*1000, endpoint, " ".join(sql.split()), tuple(parameters))
+
+    def exception(self, endpoint):
+        endpoint = endpoint or "none"
+        with self.lock:
+            self.exceptions[endpoint] += 1
+
+    def render(self, extra=()):
+        # The Prometheus text format. extra is [(name, type, help, value)] for anything else to include
+        out = []
+        def family(name, kind, help, samples):
+            out.append("# HELP %s %s" % (name, help))
+            out.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                out.append("%s%s %s" % (name, "{%s}" % ",".join('%s="%s"' % a for a in labels) if labels else "", value))
+
+        with self.lock:
+            family("eagle_requests_total", "counter", "Requests timed, by endpoint and status",
+                [((("endpoint", a), ("status", b)), c) for (a,b),c in sorted(self.requests.items())])
+            out.append("# HELP eagle_request_duration_seconds Time taken to answer requests, by endpoint")
+            out.append("# TYPE eagle_request_duration_seconds histogram")
+            for endpoint, counts in sorted(self.durations.items()):
+                total = 0
+                for bound, count in zip(BUCKETS + ["+Inf"], counts):
+                    total += count
+                    out.append('eagle_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (endpoint, bound, total))
+                out.append('eagle_request_duration_seconds_sum{endpoint="%s"} %f' % (endpoint, self.duration_sums[endpoint]))
+                out.append('eagle_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, total))
+            family("eagle_phase_seconds_total", "counter", "Time spent in each phase of requests, by endpoint",
+                [((("endpoint", a), ("phase", b)), "%f" % c) for (a,b),c in sorted(self.phases.items())])
+            family("eagle_sql_statements_total", "counter", "SQL statements run, by endpoint",
+                [((("endpoint", a),), b) for a,b in sorted(self.statement_counts.items())])
+            family("eagle_sql_seconds_total", "counter", "Time spent in sqlite, by endpoint",
+                [((("endpoint", a),), "%f" % b) for a,b in sorted(self.statement_seconds.items())])
+            family("eagle_slow_queries_total", "counter", "SQL statements slower than slow_query_ms", [((), self.counts["slow_queries"])])
+            family("eagle_exceptions_total", "counter", "Unhandled exceptions turned into a 500, by endpoint",
+                [((("endpoint", a),), b) for a,b in sorted(self.exceptions.items())])
+            family("eagle_profiles_total", "counter", "Requests profiled", [((), self.counts["profiles"])])
+        for name, kind, help, value in extra:
+            family(name, kind, help, [((), value)])
+        return "\n".join(out) + "\n"
@@ -1,15 +1,14 @@
 #!/usr/bin/env python3
 
-import json, os, sys, sqlite3
-from collections import Counter, OrderedDict
-
-# sqlite has no real equivalent to "TRUNCATE TABLE x". "DELETE FROM x" is recommended but it's slow.
-# It turns out that dropping the table is also slow. It follows that the quickest way to remove all
-# rows is to delete the DB file itself
+import argparse, datetime, gzip, json, math, os, sys, sqlite3, time
+from collections import Counter, OrderedDict, deque
 
 with open("codes/tiploc.json") as f:
     TIPLOC = json.load(f)
 
+# Grid references for the TIPLOCs which have one, for distances along each schedule
+COORDINATES = {a: (b["easting"], b["northing"]) for a,b in TIPLOC.items() if b["loc_source"]}
+
 def process_tiploc(tiploc, name, stanox, crs):
     entry = TIPLOC.get(tiploc)
     if entry:
@@ -17,15 +16,8 @@ def process_tiploc(tiploc, name, stanox, crs):
     else:
         return (tiploc, name, "N", stanox, crs)
 
-try:
-    os.remove('schedule.db')
-except FileNotFoundError:
-    pass
-
-conn = sqlite3.connect('schedule.db')
-c = conn.cursor()
-
-c.execute("""CREATE TABLE schedules(
+SCHEMA = [
+    """CREATE TABLE schedules(
     iid INTEGER,
     uid CHAR(6),
     valid_from DATE,
@@ -51,11 +43,8 @@ c.execute("""CREATE TABLE schedules(
     uic_code CHAR(5),
     atoc_code CHAR(2),
     applicable_timetable CHAR(1)
-);""")
-c.execute("CREATE INDEX idx_uid ON schedules(uid);")
-c.execute("CREATE INDEX idx_sched_iid ON schedules(iid);")
-
-c.execute("""CREATE TABLE associations(
+);""",
+    """CREATE TABLE associations(
     uid CHAR(6),
     uid_assoc CHAR(6),
     valid_from DATE,
@@ -68,11 +57,8 @@ c.execute("""CREATE TABLE associations(
     suffix_assoc CHAR(1),
     type CHAR(1),
     stp CHAR(1)
-);""")
-c.execute("CREATE INDEX idx_main_uid ON associations(uid);")
-c.execute("CREATE INDEX idx_assoc_uid ON associations(uid_assoc);")
-
-c.execute("""CREATE TABLE locations(
+);""",
+    """CREATE TABLE locations(
     iid INTEGER,
     seq INTEGER,
     tiploc CHAR(7),
@@ -88,20 +74,87 @@ c.execute("""CREATE TABLE locations(
     activity CHAR(12),
     engineering_allowance CHAR(2),
     pathing_allowance CHAR(2),
-    performance_allowance CHAR(2)
-);""")
-c.execute("CREATE INDEX idx_loc_iid ON locations(iid);")
-
-c.execute("""CREATE TABLE codes(
+    performance_allowance CHAR(2),
+    distance INTEGER,
+    time_key INTEGER
+);""",
+    """CREATE TABLE codes(
     tiploc CHAR(7),
     name CHAR(26),
     name_source CHAR(1),
     stanox CHAR(5),
     crs CHAR(3)
-);""")
-c.execute("CREATE INDEX idx_codes_tiploc ON codes(tiploc);")
-c.execute("CREATE INDEX idx_codes_stanox ON codes(stanox);")
-c.execute("CREATE INDEX idx_codes_crs    ON codes(crs);")
+);""",
+    """CREATE TABLE extracts(
+    mainframe_identity CHAR(20),
+    extract_date DATE,
+    extract_time CHAR(4),
+    current_reference CHAR(7),
+    previous_reference CHAR(7),
+    update_indicator CHAR(1),
+    version CHAR(1),
+    user_date_start DATE,
+    user_date_end DATE
+);""",
+    # The schedule rowfor would pick for each uid running on each date, for the first few days of the extract
+    """CREATE TABLE calendar(
+    date DATE,
+    uid CHAR(6),
+    iid INTEGER,
+    PRIMARY KEY (date, uid)
+) WITHOUT ROWID;""",
+    """CREATE TABLE calendar_dates(
+    date DATE PRIMARY KEY
+);""",
+    # First and last TIPLOC of each schedule, which is all that's needed of an associated train
+    """CREATE TABLE endpoints(
+    iid INTEGER PRIMARY KEY,
+    origin CHAR(7),
+    destination CHAR(7)
+);""",
+    ]
+
+# Bulk loads build these after the ZZ trailer, maintaining them row-by-row is most of the insert cost
+# Each is shaped for the queries in queries.py, check_plans.py makes sure they're actually used
+INDEXES = [
+    "CREATE INDEX idx_uid ON schedules(uid, stp, valid_from, valid_to);",
+    "CREATE INDEX idx_sched_iid ON schedules(iid);",
+    "CREATE INDEX idx_main_uid ON associations(uid, valid_from, valid_to);",
+    "CREATE INDEX idx_assoc_uid ON associations(uid_assoc, valid_from, valid_to);",
+    "CREATE INDEX idx_loc_iid ON locations(iid, seq);",
+    "CREATE INDEX idx_loc_time ON locations(tiploc, time_key, iid, seq);",
+    "CREATE INDEX idx_codes_tiploc ON codes(tiploc);",
+    "CREATE INDEX idx_codes_stanox ON codes(stanox);",
+    "CREATE INDEX idx_codes_crs    ON codes(crs);",
+    "CREATE INDEX idx_calendar_iid ON calendar(iid, date);",
+    ]
+
+# Overlay resolution as in main.py's rowfor: of the schedules valid on a date and running on its weekday,
+# the lowest STP (cancellation, new, overlay, then permanent) wins. sqlite takes the bare iid from that row
+CALENDAR_INSERT = """INSERT INTO `calendar` SELECT ?, `uid`, `iid` FROM (
+    SELECT `uid`, `iid`, min(`stp`) FROM `schedules`
+    WHERE ? BETWEEN `valid_from` AND `valid_to` AND substr(`running_days`, ?, 1)=='1' {0}
+    GROUP BY `uid`);"""
+
+ENDPOINTS_INSERT = """INSERT OR REPLACE INTO `endpoints` SELECT `iid`,
+    (SELECT `tiploc` FROM `locations` WHERE locations.iid==schedules.iid ORDER BY `seq` LIMIT 1),
+    (SELECT `tiploc` FROM `locations` WHERE locations.iid==schedules.iid ORDER BY `seq` DESC LIMIT 1)
+    FROM `schedules` WHERE `iid`>?;"""
+
+INSERTS = OrderedDict([
+    ("schedules", "INSERT INTO `schedules` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"),
+    ("associations", "INSERT INTO `associations` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"),
+    ("locations", "INSERT INTO `locations` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"),
+    ("codes", "INSERT INTO `codes` VALUES (?, ?, ?, ?, ?);"),
+    ("extracts", "INSERT INTO `extracts` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"),
+    ])
+
+# Update extracts delete rows by these keys before (R)evising or instead of (N)ew
+DELETES = {
+    "-schedules": "SELECT iid FROM `schedules` WHERE `uid`==? AND `valid_from`==? AND `stp`==?;",
+    "-associations": "DELETE FROM `associations` WHERE `uid`==? AND `uid_assoc`==? AND `valid_from`==? AND `tiploc`==? AND `stp`==?;",
+    "-codes": "DELETE FROM `codes` WHERE `tiploc`==?;",
+    }
 
 def convert_chars(string):
     return string
@@ -133,6 +186,8 @@ class ParseEntity():
 RECORDS = {
     "HD": "C20:mainframe_identity, D6:extract_date, R4:extract_time, C7:current_reference, C7:previous_reference, C:update_indicator, C:version, D6:user_date_start, D6:user_date_end, S20",
     "TI": "R7:tiploc, N2:caps_ident, N6:nlc, C:nlc_check, R26:description_tps, C5:stanox, N4:pomcp, U3:crs, R16:description_nlc, S8",
+    "TA": "R7:tiploc, N2:caps_ident, N6:nlc, C:nlc_check, R26:description_tps, C5:stanox, N4:pomcp, U3:crs, R16:description_nlc, U7:new_tiploc, S1",
+    "TD": "R7:tiploc, S71",
     "AA": "S, C6:uid_main, C6:uid_assoc, D6:valid_from, D6:valid_to, C7:assoc_days, U2:category, C:date_indicator, R7:tiploc, N:suffix, N:suffix_assoc, S, C:assoc_type, S31, C:stp",
     "BS": "S, C6:uid, D6:valid_from, D6:valid_to, C7:days_running, C:bankholiday_running, C:status, C2:category, U4:signalling_id, U4:headcode, S, S8, C1:business_sector, U3:power, U4:timing_load, U3:speed, C6:operating_characteristics, U:seating_class, U:sleepers, U:reservations, S, C4:catering, C4:branding, S, C:stp",
     "BX": "C4:traction_class, R5:uic_code, C2:atoc_code, C:applicable_timetable, S64",
@@ -143,37 +198,38 @@ RECORDS = {
     "ZZ": "S78",
 }
 
+def parse_spec(spec):
+    # [(conversion character, offset, length, tag)], offsets counting the two character record type
+    fields = []
+    ptr = 2
+    for entity in spec.split(","):
+        entity = entity.strip()
+        length, tag = 1, None
+        if ":" in entity:
+            entity, tag = entity.split(":", 1)
+        func_char = entity[:1]
+        entity = entity[1:]
+        if entity:
+            length = int(entity.strip())
+        if tag:
+            tag = tag.strip()
+        fields.append((func_char, ptr, length, tag))
+        ptr += length
+    return fields
+
 def compile_records():
-    global RECORDS
+    global ENTITIES
     functs = {"C": convert_chars, "D": convert_date, "N": convert_number, "S": convert_discard, "R": convert_string, "U": convert_stringornull, "I": convert_discard}
-    ro = {}
-    for rs in RECORDS:
-        struct = RECORDS[rs]
-        struct = struct.split(",")
-        lr = []
-        for entity in struct:
-            entity = entity.strip()
-            funct, length, tag = None, 1, None
-            if ":" in entity:
-                entity, tag = entity.split(":", 1)
-            func_char = entity[:1]
-            entity = entity[1:]
-            if entity:
-                length = int(entity.strip())
-            if tag:
-                tag = tag.strip()
-            lr.append(ParseEntity(functs[func_char], length, tag))
-        ro[rs] = lr
-    RECORDS = ro
+    ENTITIES = {rs: [ParseEntity(functs[func_char], length, tag) for func_char, _, length, tag in parse_spec(RECORDS[rs])] for rs in RECORDS}
 
 def r2d(record):
-    global RECORDS
+    global ENTITIES
     record_type = record[:2]
     record_ptr = 2
     store_dict = record_type[0] in ["L","T"]
     rdict = {}
     rl = []
-    for element in RECORDS[record_type]:
+    for element in ENTITIES[record_type]:
         string = record[record_ptr:record_ptr+element.length]
         converted = element.parse(string)
         if element.tag:
@@ -184,50 +240,479 @@ def r2d(record):
         record_ptr += element.length
     return (record_type, rdict if store_dict else rl)
 
+LOCATION_FIELDS = ["tiploc", "tiploc_instance", "arrival", "public_arrival", "departure", "public_departure", "pass",
+    "platform", "line", "path", "activity", "engineering_allowance", "pathing_allowance", "performance_allowance"]
+
+# What each decoder returns, in insert order. Anything not listed returns its tagged fields in spec order
+DECODED_FIELDS = {
+    "TI": ["tiploc", "description_tps", "stanox", "crs"],
+    "TA": ["tiploc", "description_tps", "stanox", "crs", "new_tiploc"],
+    "LO": LOCATION_FIELDS,
+    "LI": LOCATION_FIELDS,
+    "LT": LOCATION_FIELDS,
+}
+
+# Public times of 0000 mean the location isn't advertised
+NULL_VALUES = {"public_arrival": "0000", "public_departure": "0000"}
+
+def field_source(func_char, start, length):
+    string = "r[%d:%d]" % (start, start+length)
+    if func_char == "C":
+        return string
+    elif func_char == "R":
+        return string + ".rstrip()"
+    elif func_char == "U":
+        return "(%s.rstrip() or None)" % string
+    elif func_char == "N":
+        return "(int(%s) if %s.strip() else None)" % (string, string)
+    elif func_char == "D":
+        return '"20"+r[{0}:{1}]+"-"+r[{1}:{2}]+"-"+r[{2}:{3}]'.format(start, start+2, start+4, start+6)
+    else:
+        return "None"
+
+def compile_decoders():
+    # Generates one function per record type, e.g. decode_BX(r) -> (r[2:6], r[6:11].rstrip(), r[11:13], r[13:14]),
+    # so decoding a record is a single call with the slicing and conversion inlined
+    decoders = {}
+    for rs in RECORDS:
+        spec = parse_spec(RECORDS[rs])
+        fields = {tag: (func_char, start, length) for func_char, start, length, tag in spec if tag}
+        sources = []
+        # Without a DECODED_FIELDS entry, fields are in the spec's order. Dicts aren't ordered before Python 3.6
+        for tag in DECODED_FIELDS.get(rs, [tag for _, _, _, tag in spec if tag]):
+            source = field_source(*fields[tag])
+            if tag in NULL_VALUES and fields[tag][0] != "I":
+                source = "(None if r[%d:%d] == %r else %s)" % (fields[tag][1], fields[tag][1]+fields[tag][2], NULL_VALUES[tag], source)
+            sources.append(source)
+        source = "def decode_%s(r):\n    return (%s)\n" % (rs, "".join(a + ", " for a in sources))
+        namespace = {}
+        exec(source, namespace)
+        decoders[rs] = namespace["decode_" + rs]
+        decoders[rs].source = source
+    return decoders
+
 compile_records()
+DECODERS = compile_decoders()
 
-lol = False
-with open("sched.cif", "rb") as f:
-    bs_id = -1
-    loc_id = 0
-    count = 0
+# Records read per block when streaming an extract
+BLOCK_RECORDS = 8192
+
+class TableWriter():
+    # Buffers rows per table and hands them to executemany, a batch size of 1 is the old row-at-a-time behaviour
+    def __init__(self, cursor, batch_size=1):
+        self.c = cursor
+        self.batch_size = batch_size
+        self.pending = OrderedDict((table, []) for table in INSERTS)
+        self.rows = Counter()
+        self.seconds = Counter()
+
+    def insert(self, table, row):
+        pending = self.pending[table]
+        pending.append(row)
+        if len(pending) >= self.batch_size:
+            self.flush(table)
+
+    def extend(self, table, rows):
+        pending = self.pending[table]
+        pending.extend(rows)
+        if len(pending) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table=None):
+        for table in ([table] if table else list(self.pending)):
+            rows = self.pending[table]
+            if not rows: continue
+            start = time.perf_counter()
+            self.c.executemany(INSERTS[table], rows)
+            self.seconds[table] += time.perf_counter() - start
+            self.rows[table] += len(rows)
+            self.pending[table] = []
+
+    def report(self):
+        for table in INSERTS:
+            rows, seconds = self.rows[table], self.seconds[table]
+            print("%-12s %9d rows %8.2fs %10.0f rows/s" % (table, rows, seconds, rows/seconds if seconds else 0))
+
+def create_database(path, bulk=False, cache_mb=512):
+    # sqlite has no real equivalent to "TRUNCATE TABLE x". "DELETE FROM x" is recommended but it's slow.
+    # It turns out that dropping the table is also slow. It follows that the quickest way to remove all
+    # rows is to delete the DB file itself
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    if bulk:
+        # This is a fresh shadow file which is thrown away if anything goes wrong, so there's nothing
+        # for a journal or fsync to protect
+        c.execute("PRAGMA journal_mode=OFF;")
+        c.execute("PRAGMA synchronous=OFF;")
+        c.execute("PRAGMA locking_mode=EXCLUSIVE;")
+        c.execute("PRAGMA temp_store=MEMORY;")
+        c.execute("PRAGMA cache_size=-%d;" % (cache_mb*1024))
+    for statement in SCHEMA:
+        c.execute(statement)
+    if not bulk:
+        create_indexes(c)
+    return conn
+
+def create_indexes(c, verbose=False):
+    for statement in INDEXES:
+        start = time.perf_counter()
+        c.execute(statement)
+        if verbose:
+            print("%-50s %8.2fs" % (statement, time.perf_counter()-start))
+
+def open_extract(path):
+    # Plain or gzipped CIF, from a file or "-" for stdin. Gzip is recognised by its magic number rather
+    # than the file name, so `curl ... | parse_cif.py -` works too
+    if path == "-":
+        f = sys.stdin.buffer
+        return gzip.GzipFile(fileobj=f) if f.peek(2)[:2] == b"\x1f\x8b" else f
+    with open(path, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rb") if gzipped else open(path, "rb")
+
+def read_blocks(f, size=BLOCK_RECORDS*81):
+    # Yields memoryviews of whole records, read into one reused buffer. Each is only valid until the next
+    buf = bytearray(size)
+    view = memoryview(buf)
+    filled = 0
     while True:
-        # All records are padded to 80cols
-        record = f.read(80).decode("ascii")
-        # And have a following \n which isn't
-        f.read(1)
+        n = f.readinto(view[filled:])
+        filled += n
+        if not n or filled == size:
+            whole = filled if not n else filled - filled%81
+            if not whole:
+                return
+            yield view[:whole]
+            buf[:filled-whole] = buf[whole:filled]
+            filled -= whole
 
-        record_type, res = r2d(record)
-        count +=1
-        if count%10000==0:
-            sys.stdout.write("\r%8s %s" % (count, record_type))
-            sys.stdout.flush()
+def read_records(f):
+    count = 0
+    for block in read_blocks(f):
+        # All records are padded to 80cols, and have a following \n which isn't. Decoding a block at a time
+        # leaves only a str slice per record
+        text = str(block, "ascii")
+        for i in range(0, len(text)-79, 81):
+            yield text[i:i+80]
+        count += len(text)//81
+        sys.stdout.write("\r%8s %s" % (count, text[-81:-79]))
+        sys.stdout.flush()
+
+def time_key(time):
+    # Half minutes since midnight, so boards can be ordered and windowed in sqlite. 1234H sorts after 1234
+    if not time:
+        return None
+    return (int(time[:2])*60 + int(time[2:4]))*2 + (time[4:] == "H")
+
+def parse_records(records, bs_id=-1):
+    # Yields (table, row) pairs ready for insertion, and finally ("ZZ", record) for the trailer.
+    # iids are allocated sequentially from bs_id+1, so a chunk starting at a BS can be parsed in isolation.
+    # Updates also yield ("-table", key) for rows to delete, full extracts only ever contain (N)ew records
+    loc_id = 0
+    schedule = None
+    for record in records:
+        record_type = record[:2]
+        res = DECODERS[record_type](record)
+
+        # A BS is held back until we know whether a BX follows it, so each schedule is written once, complete
+        if schedule and record_type != "BX":
+            yield "schedules", (bs_id,) + schedule + extra
+            schedule = None
 
         if record_type == "AA":
-            c.execute("INSERT INTO `associations` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
-                res)
+            # The transaction type, (N)ew, (D)elete or (R)evise, isn't stored so it's read straight off the record
+            if record[2] != "N":
+                yield "-associations", (res[0], res[1], res[2], res[7], res[-1])
+            if record[2] != "D":
+                yield "associations", res
         elif record_type == "TI":
-            c.execute("INSERT INTO `codes` VALUES (?, ?, ?, ?, ?);", process_tiploc(res["tiploc"], res["description_tps"], res["stanox"], res["crs"]))
+            yield "codes", process_tiploc(*res)
+        elif record_type == "TA":
+            yield "-codes", res[0]
+            yield "codes", process_tiploc(res[4] or res[0], *res[1:4])
+        elif record_type == "TD":
+            yield "-codes", res[0]
         elif record_type == "BS":
-            bs_id += 1
-            loc_id = 0
-            c.execute("INSERT INTO `schedules` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
-                [bs_id] + res + [None, None, "ZZ", None])
+            if record[2] != "N":
+                yield "-schedules", (res[0], res[1], res[-1])
+            if record[2] != "D":
+                bs_id += 1
+                loc_id = 0
+                metres, last_en = 0, None
+                schedule, extra = res, (None, None, "ZZ", None)
         elif record_type == "BX":
-            c.execute("UPDATE `schedules` SET traction_class=?, uic_code=?, atoc_code=?, applicable_timetable=? WHERE `iid`==?;",
-                res + [bs_id])
+            extra = res
         elif record_type == "LO" or record_type=="LI" or record_type=="LT":
-            if res["public_arrival"] == "0000": res["public_arrival"] = None
-            if res["public_departure"] == "0000": res["public_departure"] = None
-            c.execute("INSERT INTO `locations` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", (
-                bs_id, loc_id, res["tiploc"], res["tiploc_instance"], res["arrival"], res["public_arrival"],
-                res["departure"], res["public_departure"], res["pass"], res["platform"], res["line"],
-                res["path"], res["activity"], res["engineering_allowance"], res["pathing_allowance"], res["performance_allowance"]
-                ))
+            # Metres travelled so far, in straight lines between the locations we have grid references for
+            en = COORDINATES.get(res[0])
+            if en:
+                if last_en:
+                    metres += int(math.sqrt((last_en[0]-en[0])**2 + (last_en[1]-en[1])**2))
+                last_en = en
+            # Boards are ordered by departure, arrival, then passing time, whichever the location has
+            yield "locations", (bs_id, loc_id) + res + (metres, time_key(res[4] or res[2] or res[6]))
             loc_id += 1
         elif record_type == "ZZ":
-            print()
-            print(record)
-            conn.commit()
-            conn.close()
-            exit()
+            yield "ZZ", record
+            return
+    if schedule:
+        yield "schedules", (bs_id,) + schedule + extra
+
+def load_serial(f, writer):
+    for table, row in parse_records(read_records(f)):
+        if table == "ZZ":
+            return row
+        writer.insert(table, row)
+
+def split_chunks(f, chunk_records):
+    # Cut the file into runs of whole records, each (apart from the first) starting at a BS, so a
+    # schedule's BX and locations always travel with it
+    carry = b""
+    while True:
+        block = f.read(chunk_records*81)
+        if not block:
+            break
+        data = carry + block
+        # Records are 81 bytes including their newline, so "\nBS" can only ever be the start of a BS
+        cut = data.rfind(b"\nBS") + 1
+        if cut <= 0:
+            carry = data
+            continue
+        yield data[:cut]
+        carry = data[cut:]
+    if carry:
+        yield carry
+
+def parse_chunk(args):
+    chunk, bs_id = args
+    text = chunk.decode("ascii")
+    records = (text[i:i+80] for i in range(0, len(text)-79, 81))
+    tables = OrderedDict((table, []) for table in INSERTS)
+    trailer = None
+    for table, row in parse_records(records, bs_id):
+        if table == "ZZ":
+            trailer = row
+            break
+        tables[table].append(row)
+    return len(text)//81, tables, trailer
+
+def load_parallel(f, writer, jobs, chunk_records):
+    import multiprocessing
+    trailer = None
+    count = 0
+    bs_id = -1
+    in_flight = deque()
+
+    def write(result):
+        nonlocal trailer, count
+        records, tables, chunk_trailer = result
+        for table, rows in tables.items():
+            writer.extend(table, rows)
+        trailer = trailer or chunk_trailer
+        count += records
+        sys.stdout.write("\r%8s" % count)
+        sys.stdout.flush()
+
+    with multiprocessing.Pool(jobs) as pool:
+        for chunk in split_chunks(f, chunk_records):
+            # iids are handed out here, in file order, so every worker agrees on them without talking
+            # to the others. "\nBS" counts every BS bar one at the very start of the chunk
+            in_flight.append(pool.apply_async(parse_chunk, ((chunk, bs_id),)))
+            bs_id += chunk.count(b"\nBS") + chunk.startswith(b"BS")
+            # Results are written in order, and only a couple of chunks per worker are read ahead
+            while len(in_flight) >= jobs*2:
+                write(in_flight.popleft().get())
+            if trailer: break
+        while in_flight:
+            write(in_flight.popleft().get())
+    return trailer
+
+def update_endpoints(c, after):
+    # Schedules deleted by an update leave their endpoints behind, and iids after the previous maximum may
+    # have been handed out again
+    c.execute("SELECT name FROM sqlite_master WHERE name=='endpoints';")
+    if not c.fetchone():
+        return
+    c.execute("DELETE FROM `endpoints` WHERE `iid` NOT IN (SELECT `iid` FROM `schedules`);")
+    c.execute(ENDPOINTS_INSERT, (after,))
+
+def calendar_date(c, date):
+    c.execute(CALENDAR_INSERT.format(""), (date.isoformat(), date.isoformat(), date.weekday()+1))
+    c.execute("INSERT INTO `calendar_dates` VALUES (?);", (date.isoformat(),))
+
+def build_calendar(c, start, days):
+    for n in range(days):
+        calendar_date(c, start + datetime.timedelta(days=n))
+
+def update_calendar(c, uids, start, days):
+    # Re-resolves the given uids on every date the calendar already covers, then moves it on to cover days
+    # from the update's start, dropping the dates before it. Otherwise a database kept current by updates
+    # alone would run out of calendar once the full extract's days had passed
+    c.execute("SELECT name FROM sqlite_master WHERE name=='calendar_dates';")
+    if not c.fetchone():
+        return
+    c.execute("DELETE FROM `calendar` WHERE `date`<?;", (start.isoformat(),))
+    c.execute("DELETE FROM `calendar_dates` WHERE `date`<?;", (start.isoformat(),))
+    c.execute("SELECT `date` FROM `calendar_dates`;")
+    dates = [a[0] for a in c.fetchall()]
+    uids = list(uids)
+    for i in range(0, len(uids), 500):
+        chunk = uids[i:i+500]
+        placeholders = ",".join("?"*len(chunk))
+        for date in dates:
+            weekday = datetime.date(*map(int, date.split("-"))).weekday()
+            c.execute("DELETE FROM `calendar` WHERE `date`==? AND `uid` IN (%s);" % placeholders, [date] + chunk)
+            c.execute(CALENDAR_INSERT.format("AND `uid` IN (%s)" % placeholders), [date, date, weekday+1] + chunk)
+    # New dates are resolved whole, after the update, so there's nothing to re-resolve on them
+    for n in range(days):
+        date = start + datetime.timedelta(days=n)
+        if date.isoformat() not in dates:
+            calendar_date(c, date)
+
+def apply_update(c, f):
+    # Everything happens in the caller's transaction, so the API carries on reading the old timetable
+    # until the whole update is committed
+    c.execute("SELECT max(iid) FROM `schedules`;")
+    bs_id = c.fetchone()[0]
+    bs_id = -1 if bs_id is None else bs_id
+    counts = Counter()
+    uids = set()
+    for table, row in parse_records(read_records(f), bs_id):
+        if table == "ZZ":
+            update_endpoints(c, bs_id)
+            return row, counts, uids
+        elif table == "-schedules":
+            c.execute(DELETES[table], row)
+            iids = c.fetchall()
+            c.executemany("DELETE FROM `locations` WHERE `iid`==?;", iids)
+            c.executemany("DELETE FROM `schedules` WHERE `iid`==?;", iids)
+            counts[table] += len(iids)
+            uids.add(row[0])
+        elif table in DELETES:
+            c.execute(DELETES[table], (row,) if table == "-codes" else row)
+            counts[table] += c.rowcount
+        else:
+            c.execute(INSERTS[table], row)
+            counts[table] += 1
+            if table == "schedules":
+                uids.add(row[1])
+    return None, counts, uids
+
+def last_reference(c):
+    try:
+        c.execute("SELECT `current_reference` FROM `extracts` ORDER BY rowid DESC LIMIT 1;")
+    except sqlite3.OperationalError:
+        # Databases loaded before extracts were recorded
+        c.execute([a for a in SCHEMA if "TABLE extracts" in a][0])
+        return None
+    row = c.fetchone()
+    return row[0] if row else None
+
+def load_update(args, f, header):
+    if not os.path.exists('schedule.db'):
+        sys.exit("An update extract needs an existing schedule.db to apply to")
+    conn = sqlite3.connect('schedule.db')
+    c = conn.cursor()
+    # Readers can carry on alongside the update until it commits, but only while its changes fit in the page
+    # cache. Once they spill to the file, sqlite locks readers out for the rest of the transaction
+    c.execute("PRAGMA cache_size=-%d;" % (args.cache_mb*1024))
+    started = time.perf_counter()
+
+    # Each update names the extract it follows, and applying one out of sequence would silently lose changes
+    reference = last_reference(c)
+    if reference == header[3] and not args.force:
+        sys.exit("Extract %s has already been applied" % header[3])
+    if reference != header[4] and not args.force:
+        sys.exit("Extract %s follows %s, but the database is at %s. Use --force to apply it anyway" % (header[3], header[4], reference))
+
+    trailer, counts, uids = apply_update(c, f)
+    print()
+    if not trailer:
+        conn.rollback()
+        conn.close()
+        sys.exit("No ZZ trailer found, the extract is probably truncated. Nothing has been applied")
+    print(trailer)
+    update_calendar(c, uids, datetime.date(*map(int, header[7].split("-"))), args.calendar_days)
+    c.execute(INSERTS["extracts"], header)
+    conn.commit()
+    conn.close()
+    for table, count in sorted(counts.items()):
+        print("%-14s %9d rows %s" % (table.lstrip("-"), count, "deleted" if table[0] == "-" else "inserted"))
+    print("Applied in %.2fs" % (time.perf_counter()-started))
+
+def load_full(args, f, header):
+    jobs = args.jobs or os.cpu_count()
+    # Built alongside the live database and renamed over it once complete, so the API never sees a
+    # partial timetable and main.py can switch to the new file between requests
+    shadow = "schedule.db.%s.new" % time.strftime("%Y%m%dT%H%M%S")
+    conn = create_database(shadow, args.bulk, args.cache_mb)
+    c = conn.cursor()
+    writer = TableWriter(c, args.batch_size if args.bulk else 1)
+    started = time.perf_counter()
+
+    try:
+        writer.insert("extracts", header)
+        if jobs > 1:
+            trailer = load_parallel(f, writer, jobs, args.chunk_records)
+        else:
+            trailer = load_serial(f, writer)
+
+        print()
+        if not trailer:
+            sys.exit("No ZZ trailer found, the extract is probably truncated")
+        print(trailer)
+        writer.flush()
+        if args.bulk:
+            create_indexes(c, True)
+        c.execute(ENDPOINTS_INSERT, (-1,))
+        calendar_started = time.perf_counter()
+        build_calendar(c, datetime.date(*map(int, header[7].split("-"))), args.calendar_days)
+        print("Calendar for %d days built in %.2fs" % (args.calendar_days, time.perf_counter()-calendar_started))
+        conn.commit()
+        conn.close()
+    except BaseException:
+        conn.close()
+        os.remove(shadow)
+        raise
+
+    # Bulk loads don't sync as they go, so make sure it's all on disk before it replaces anything
+    fd = os.open(shadow, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(shadow, 'schedule.db')
+    writer.report()
+    print("Loaded in %.2fs" % (time.perf_counter()-started))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load a CIF extract into schedule.db")
+    parser.add_argument("extract", nargs="?", default="sched.cif", help="CIF file, optionally gzipped, or - for stdin")
+    parser.add_argument("--bulk", action="store_true", help="batch inserts, build indexes after loading, and disable journalling")
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows per executemany in bulk mode")
+    parser.add_argument("--cache-mb", type=int, default=512, help="sqlite page cache size in bulk mode, and for updates")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes parsing records, 0 for one per CPU")
+    parser.add_argument("--chunk-records", type=int, default=50000, help="records per chunk handed to a worker")
+    parser.add_argument("--calendar-days", type=int, default=14, help="days from the start of the extract to resolve overlays for in advance, moved on by each update")
+    parser.add_argument("--force", action="store_true", help="apply an update extract even if it's out of sequence")
+    args = parser.parse_args()
+
+    with open_extract(args.extract) as f:
+        header = f.read(81).decode("ascii")
+        if header[:2] != "HD":
+            sys.exit("Extract doesn't start with an HD record")
+        header = DECODERS["HD"](header)
+        print("%s %s, extract %s" % (header[0], "update" if header[5] == "U" else "full", header[3]))
+        # Full extracts rebuild the database from scratch, updates are applied in place
+        if header[5] == "U":
+            load_update(args, f, header)
+        else:
+            load_full(args, f, header)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# SQL run by main.py on every request. They're kept together so check_plans.py can make sure none of
+# them ever falls back to scanning a whole table
+
+SCHEDULES_FOR_UID = "SELECT * FROM `schedules` WHERE `uid`==? AND ? BETWEEN `valid_from` AND `valid_to` ORDER BY `stp` DESC;"
+
+LOCATIONS_FOR_IID = "SELECT codes.*,locations.* FROM locations LEFT JOIN codes ON locations.tiploc==codes.tiploc WHERE locations.iid==? ORDER BY locations.seq;"
+
+ASSOCIATIONS_FOR_UID = "SELECT * FROM `associations` WHERE (`uid`==? OR `uid_assoc`==?) AND ? BETWEEN `valid_from` AND `valid_to` ORDER BY `stp` DESC;"
+
+# The first and last locations of a schedule, named as LOCATIONS_FOR_IID would name them
+ENDPOINTS_FOR_IID = """SELECT endpoints.origin AS origin_tiploc, origin.name AS origin_name, origin.crs AS origin_crs,
+    endpoints.destination AS dest_tiploc, dest.name AS dest_name, dest.crs AS dest_crs FROM endpoints
+    LEFT JOIN codes AS origin ON origin.tiploc==endpoints.origin LEFT JOIN codes AS dest ON dest.tiploc==endpoints.destination
+    WHERE endpoints.iid==?;"""
+
+CODES_BY_STANOX = "SELECT * FROM `codes` WHERE `stanox`==?;"
+CODES_BY_CRS = "SELECT * FROM `codes` WHERE `crs`==?;"
+CODES_BY_TIPLOC = "SELECT * FROM `codes` WHERE `tiploc`==?;"
+
+# Batched versions for departure boards. {0} is a list of placeholders, one per value
+
+# Every schedule valid today for each uid with a schedule running today at one of the given TIPLOCs.
+# That's all of the candidates rowfor would pick between, for all of those uids at once
+SCHEDULES_CALLING_AT = """SELECT * FROM `schedules` WHERE `uid` IN (
+    SELECT schedules.uid FROM locations JOIN schedules ON locations.iid==schedules.iid
+    WHERE locations.tiploc IN ({0}) AND ? BETWEEN schedules.valid_from AND schedules.valid_to AND schedules.running_days LIKE ?
+    ) AND ? BETWEEN `valid_from` AND `valid_to` ORDER BY `uid`, `stp` DESC;"""
+
+SCHEDULES_FOR_UIDS = "SELECT * FROM `schedules` WHERE `uid` IN ({0}) AND ? BETWEEN `valid_from` AND `valid_to` ORDER BY `uid`, `stp` DESC;"
+
+SCHEDULES_FOR_IIDS = "SELECT * FROM `schedules` WHERE `iid` IN ({0});"
+
+LOCATIONS_FOR_IIDS = "SELECT codes.*,locations.* FROM locations LEFT JOIN codes ON locations.tiploc==codes.tiploc WHERE locations.iid IN ({0}) ORDER BY locations.iid, locations.seq;"
+
+ASSOCIATIONS_FOR_UIDS = "SELECT * FROM `associations` WHERE (`uid` IN ({0}) OR `uid_assoc` IN ({0})) AND ? BETWEEN `valid_from` AND `valid_to` ORDER BY `stp` DESC;"
+
+# The calendar table holds the winning schedule for each uid running on each date it covers, so these
+# replace the overlay resolution above with a single probe. Dates outside it fall back to the queries above
+CALENDAR_DATES = "SELECT `date` FROM `calendar_dates`;"
+
+CALENDAR_SCHEDULE = "SELECT schedules.* FROM calendar JOIN schedules ON schedules.iid==calendar.iid WHERE calendar.date==? AND calendar.uid==?;"
+
+CALENDAR_SCHEDULES = "SELECT schedules.* FROM calendar JOIN schedules ON schedules.iid==calendar.iid WHERE calendar.date==? AND calendar.uid IN ({0});"
+
+CALENDAR_CALLING_AT = """SELECT DISTINCT schedules.* FROM locations
+    JOIN calendar ON calendar.iid==locations.iid AND calendar.date==?
+    JOIN schedules ON schedules.iid==locations.iid
+    WHERE locations.tiploc IN ({0}) ORDER BY schedules.uid;"""
+
+# One page of a board: calls at the given TIPLOCs by trains running on a date, from a given time and after a given
+# (time_key, iid, seq), in that order. time_key is in half minutes past midnight
+CALENDAR_DEPARTURES = """SELECT locations.iid, locations.seq, locations.time_key FROM locations
+    JOIN calendar ON calendar.iid==locations.iid AND calendar.date==?
+    WHERE locations.tiploc IN ({0}) AND locations.time_key>=? AND locations.time_key<?
+    AND (locations.time_key, locations.iid, locations.seq)>(?, ?, ?)
+    ORDER BY locations.time_key, locations.iid, locations.seq LIMIT ?;"""
+
+# Whole days for /json/export, schedules and their locations in the same iid order so the two can be read side by
+# side. Dates the calendar covers are read from it, others resolved as parse_cif.py's CALENDAR_INSERT does
+EXPORT_SCHEDULES = "SELECT schedules.* FROM calendar JOIN schedules ON schedules.iid==calendar.iid WHERE calendar.date==? ORDER BY calendar.iid;"
+
+EXPORT_LOCATIONS = """SELECT codes.*,locations.* FROM calendar JOIN locations ON locations.iid==calendar.iid
+    LEFT JOIN codes ON locations.tiploc==codes.tiploc WHERE calendar.date==? ORDER BY locations.iid, locations.seq;"""
+
+EXPORT_SCHEDULES_RESOLVED = """SELECT schedules.* FROM (
+    SELECT `iid`, min(`stp`) FROM `schedules` WHERE ? BETWEEN `valid_from` AND `valid_to` AND substr(`running_days`, ?, 1)=='1' GROUP BY `uid`
+    ) AS running JOIN schedules ON schedules.iid==running.iid ORDER BY schedules.iid;"""
+
+EXPORT_LOCATIONS_RESOLVED = """SELECT codes.*,locations.* FROM (
+    SELECT `iid`, min(`stp`) FROM `schedules` WHERE ? BETWEEN `valid_from` AND `valid_to` AND substr(`running_days`, ?, 1)=='1' GROUP BY `uid`
+    ) AS running JOIN locations ON locations.iid==running.iid
+    LEFT JOIN codes ON locations.tiploc==codes.tiploc ORDER BY locations.iid, locations.seq;"""
+
+# Every association valid on a date, for journey.py's timetables
+ASSOCIATIONS_ON = "SELECT * FROM `associations` WHERE ? BETWEEN `valid_from` AND `valid_to` ORDER BY `stp` DESC;"
@@ -0,0 +1,35 @@
+import json
+
+class Tiploc():
+    # One entry from codes/tiploc.json. Slots rather than a dict each, since there are tens of thousands
+    __slots__ = ["tiploc", "name", "name_source", "stanox", "crs", "easting", "northing", "loc_source", "ldb",
+        "manager_atoc", "manager_name"]
+
+    def __init__(self, entry):
+        for field in self.__slots__:
+            setattr(self, field, entry.get(field))
+
+class Tiplocs():
+    # codes/tiploc.json, read the first time anything is looked up. Distances are stored in schedule.db now,
+    # so a server with an up to date database usually never reads it at all
+    def __init__(self, path="codes/tiploc.json"):
+        self.path = path
+        self.entries = None
+
+    def load(self):
+        if self.entries is None:
+            with open(self.path) as f:
+                self.entries = {a: Tiploc(b) for a,b in json.load(f).items()}
+        return self.entries
+
+    def __getitem__(self, tiploc):
+        return self.load()[tiploc]
+
+    def __contains__(self, tiploc):
+        return tiploc in self.load()
+
+    def __len__(self):
+        return len(self.load())
+
+    def get(self, tiploc, default=None):
+        return self.load().get(tiploc, default)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+# One day's timetable, as resolved for /json/export, written out as columns for analysis: a directory of NumPy
+# .npy files, memory mapped when read back, and meta.json holding the dictionaries which text columns are
+# encoded against. Counting trains by operator, traction or hour, or how busy platforms are, then runs over
+# whole arrays at once rather than a request per train. Needs NumPy (pip install numpy)
+
+import argparse, datetime, json, os, sys, time
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import queries, tops
+
+# Columns written for each table: (name, dtype, dictionary). Text columns are stored as indexes into their
+# dictionary, shared between columns holding the same sort of thing, with -1 for nothing. Times are minutes
+# past midnight on the day, carrying on past 1440 for trains still running after midnight, or -1
+SCHEDULE_COLUMNS = [
+    ("uid", "int32", "uid"),
+    ("stp", "int8", "stp"),
+    ("cancelled", "bool", None),
+    ("category", "int16", "category"),
+    ("signalling_id", "int32", "signalling_id"),
+    ("atoc_code", "int16", "atoc_code"),
+    ("power_type", "int16", "power_type"),
+    ("timing_load", "int16", "timing_load"),
+    ("speed", "int16", None),
+    ("seating_class", "int8", "seating_class"),
+    ("tops_inferred", "int16", "tops_inferred"),
+    ("origin", "int32", "tiploc"),
+    ("destination", "int32", "tiploc"),
+    ("departure", "int16", None),
+    ("arrival", "int16", None),
+    # Where this schedule's locations start in the locations table, and how many it has
+    ("first_location", "int32", None),
+    ("location_count", "int32", None),
+    ]
+
+LOCATION_COLUMNS = [
+    # Row of the schedule in the schedules table
+    ("schedule", "int32", None),
+    ("seq", "int16", None),
+    ("tiploc", "int32", "tiploc"),
+    ("arrival", "int16", None),
+    ("departure", "int16", None),
+    ("pass", "int16", None),
+    ("arrival_public", "int16", None),
+    ("departure_public", "int16", None),
+    ("platform", "int16", "platform"),
+    ("line", "int16", "line"),
+    ("activity", "int16", "activity"),
+    ("distance", "int32", None),
+    ]
+
+def require_numpy():
+    if numpy is None:
+        sys.exit("Snapshots need NumPy (pip install numpy)")
+
+class Dictionary():
+    # Distinct values in the order they're first seen, each stood for by its position
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def __call__(self, value):
+        if value is None or value == "":
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+class Clock():
+    # Minutes past midnight along one schedule, adding a day whenever a time goes back past midnight. Public
+    # times can be a minute before the working time they round, which isn't midnight
+    def __init__(self):
+        self.last = 0
+
+    def __call__(self, time):
+        if not time:
+            return -1
+        minutes = int(time[:2])*60 + int(time[2:4])
+        while minutes < self.last - 720:
+            minutes += 1440
+        self.last = max(self.last, minutes)
+        return minutes
+
+def write(conn, date, use_calendar, path):
+    # Reads the schedules running on date, as journey.Timetable does, and writes them to the directory path.
+    # Returns the number of schedules and locations written
+    require_numpy()
+    if use_calendar:
+        parameters = (date.isoformat(),)
+        schedule_query, location_query = queries.EXPORT_SCHEDULES, queries.EXPORT_LOCATIONS
+    else:
+        parameters = (date.isoformat(), date.weekday()+1)
+        schedule_query, location_query = queries.EXPORT_SCHEDULES_RESOLVED, queries.EXPORT_LOCATIONS_RESOLVED
+
+    dictionaries = OrderedDict((a, Dictionary()) for a in
+        sorted({c for _, _, c in SCHEDULE_COLUMNS + LOCATION_COLUMNS if c}))
+    schedules = OrderedDict((name, []) for name, _, _ in SCHEDULE_COLUMNS)
+    locations = OrderedDict((name, []) for name, _, _ in LOCATION_COLUMNS)
+    crs, names = {}, {}
+
+    rows = {}
+    for schedule in conn.execute(schedule_query, parameters):
+        rows[schedule["iid"]] = len(schedules["uid"])
+        values = {name: schedule[name] for name in ["uid", "stp", "category", "signalling_id", "atoc_code", "power_type",
+            "timing_load", "seating_class"]}
+        values.update(cancelled=schedule["stp"] == "C", speed=int(schedule["speed"]) if (schedule["speed"] or "").isdigit() else -1,
+            tops_inferred=tops.infer(schedule)["tops_inferred"], origin=None, destination=None, departure=-1, arrival=-1,
+            first_location=0, location_count=0)
+        for name, _, dictionary in SCHEDULE_COLUMNS:
+            schedules[name].append(dictionaries[dictionary](values[name]) if dictionary else values[name])
+
+    clock, last, has_distance = None, None, None
+    for location in conn.execute(location_query, parameters):
+        if has_distance is None:
+            # Databases from before distances were stored don't have them
+            has_distance = "distance" in location.keys()
+        row = rows[location["iid"]]
+        if row != last:
+            clock, last = Clock(), row
+            schedules["first_location"][row] = len(locations["schedule"])
+        tiploc = location["tiploc"]
+        crs[tiploc], names[tiploc] = location["crs"], location["name"]
+        values = {"schedule": row, "seq": location["seq"], "tiploc": tiploc, "platform": location["platform"],
+            "line": location["line"], "activity": (location["activity"] or "").strip(),
+            "distance": location["distance"] if has_distance and location["distance"] is not None else -1}
+        # In the order they happen, so each rolls over midnight from the one before
+        for name in ["arrival", "arrival_public", "pass", "departure", "departure_public"]:
+            values[name] = clock(location[name])
+        for name, _, dictionary in LOCATION_COLUMNS:
+            locations[name].append(dictionaries[dictionary](values[name]) if dictionary else values[name])
+        schedules["location_count"][row] += 1
+
+    # Ends of each schedule, from its first and last locations
+    for row, first in enumerate(schedules["first_location"]):
+        count = schedules["location_count"][row]
+        if count:
+            last = first + count - 1
+            schedules["origin"][row] = locations["tiploc"][first]
+            schedules["destination"][row] = locations["tiploc"][last]
+            schedules["departure"][row] = locations["departure"][first]
+            schedules["arrival"][row] = locations["arrival"][last]
+
+    os.makedirs(path, exist_ok=True)
+    for table, columns, specs in [("schedules", schedules, SCHEDULE_COLUMNS), ("locations", locations, LOCATION_COLUMNS)]:
+        for name, dtype, _ in specs:
+            numpy.save(os.path.join(path, "%s.%s.npy" % (table, name)), numpy.array(columns[name], dtype=dtype))
+    tiplocs = dictionaries["tiploc"].values
+    meta = OrderedDict([
+        ("date", date.isoformat()),
+        ("schedules", len(schedules["uid"])),
+        ("locations", len(locations["schedule"])),
+        ("columns", OrderedDict([
+            ("schedules", OrderedDict((name, dictionary) for name, _, dictionary in SCHEDULE_COLUMNS)),
+            ("locations", OrderedDict((name, dictionary) for name, _, dictionary in LOCATION_COLUMNS)),
+            ])),
+        ("dictionaries", OrderedDict((a, b.values) for a,b in dictionaries.items())),
+        # Alongside the tiploc dictionary, for finding and labelling stations
+        ("crs", [crs[a] for a in tiplocs]),
+        ("names", [names[a] for a in tiplocs]),
+        ])
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return meta["schedules"], meta["locations"]
+
+class Table():
+    # Columns of one table, as attributes or by name
+    def __init__(self, columns):
+        self.columns = columns
+        self.__dict__.update(columns)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+class Snapshot():
+    def __init__(self, path):
+        require_numpy()
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.date = datetime.date(*map(int, meta["date"].split("-")))
+        self.dictionaries = meta["dictionaries"]
+        self.crs, self.names = meta["crs"], meta["names"]
+        self.encodings = meta["columns"]
+        self.codes = {a: {c: n for n, c in enumerate(b)} for a,b in self.dictionaries.items()}
+        self.schedules, self.locations = [Table(OrderedDict((name, numpy.load(os.path.join(path, "%s.%s.npy" % (table, name)), mmap_mode="r"))
+            for name in meta["columns"][table])) for table in ["schedules", "locations"]]
+
+    def table(self, table):
+        return self.schedules if table == "schedules" else self.locations
+
+    def code(self, dictionary, value):
+        # The code value is stored as, or -1 if nothing was, so comparisons simply match nothing
+        return self.codes[dictionary].get(value, -1)
+
+    def decode(self, dictionary, code):
+        return None if code < 0 else self.dictionaries[dictionary][code]
+
+    def station(self, code):
+        # Codes in the tiploc dictionary for a CRS or TIPLOC
+        return numpy.array([n for n, a in enumerate(self.dictionaries["tiploc"]) if a == code or self.crs[n] == code], dtype="int32")
+
+    def per_location(self, name):
+        # A schedule column repeated for each of its locations
+        return self.schedules[name][self.locations.schedule]
+
+    def column(self, table, name):
+        # Schedule columns can be asked for by locations too. "hour" is the hour of the departure, or of the
+        # arrival for the end of a journey, counting on past 23 for after midnight
+        if name == "hour":
+            times = self.table(table)["departure"]
+            other = self.table(table)["pass" if table == "locations" else "arrival"]
+            if table == "locations":
+                times = numpy.where(times >= 0, times, numpy.where(self.locations.arrival >= 0, self.locations.arrival, other))
+            else:
+                times = numpy.where(times >= 0, times, other)
+            return times // 60, None
+        if table == "locations" and name not in self.encodings["locations"]:
+            return self.per_location(name), self.encodings["schedules"][name]
+        return self.table(table)[name], self.encodings[table][name]
+
+    def where(self, table, **conditions):
+        # A mask of rows where each column equals the value given, or any of them for a list. Dictionary encoded
+        # columns are compared by value, so where("schedules", atoc_code="VT", power_type=["EMU", "DMU"])
+        mask = numpy.ones(len(self.table(table)), dtype=bool)
+        for name, wanted in conditions.items():
+            values, dictionary = self.column(table, name)
+            wanted = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+            if dictionary:
+                wanted = [self.code(dictionary, a) for a in wanted]
+            else:
+                wanted = [int(a) for a in wanted]
+            mask &= numpy.isin(values, wanted)
+        return mask
+
+    def count(self, table, *names, mask=None):
+        # Rows by each combination of the columns named, decoded, most common first
+        columns = [self.column(table, a) for a in names]
+        stacked = numpy.stack([numpy.asarray(a, dtype="int64") for a, _ in columns], axis=1)
+        if mask is not None:
+            stacked = stacked[mask]
+        keys, counts = numpy.unique(stacked, axis=0, return_counts=True)
+        order = numpy.argsort(-counts, kind="stable")
+        return OrderedDict((tuple(self.decode(d, int(k)) if d else int(k) for k, (_, d) in zip(keys[n], columns)), int(counts[n]))
+            for n in order)
+
+    def platform_occupancy(self, code):
+        # For each platform at a station, the minutes of each hour with a train standing at it, and the most
+        # trains there at once. Returns {platform: (minutes per hour, most at once)}
+        locs = self.locations
+        mask = numpy.isin(locs.tiploc, self.station(code)) & (locs.platform >= 0) & (locs["pass"] < 0)
+        arrive = numpy.where(locs.arrival >= 0, locs.arrival, locs.departure)[mask]
+        leave = numpy.where(locs.departure >= 0, locs.departure, locs.arrival)[mask]
+        platforms = locs.platform[mask]
+        horizon = int(max(leave.max(initial=0) + 1, 1440))
+        horizon += -horizon % 60
+        ret = OrderedDict()
+        for platform in numpy.unique(platforms):
+            which = platforms == platform
+            # Trains there at each minute, a train occupying at least the minute it calls in
+            changes = numpy.zeros(horizon + 1, dtype="int32")
+            numpy.add.at(changes, arrive[which], 1)
+            numpy.add.at(changes, numpy.maximum(leave[which], arrive[which] + 1), -1)
+            present = numpy.cumsum(changes)[:horizon]
+            ret[self.decode("platform", int(platform))] = ((present > 0).reshape(-1, 60).sum(axis=1), int(present.max()))
+        return OrderedDict(sorted(ret.items(), key=lambda a: (len(a[0]), a[0])))
+
+def show_counts(counts, names, limit):
+    print("  ".join("%-14s" % a for a in names) + "  trains")
+    for key, count in list(counts.items())[:limit]:
+        print("  ".join("%-14s" % ("-" if a is None else a) for a in key) + "  %d" % count)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write or query a day's timetable as NumPy columns")
+    # Not required=True, which needs Python 3.7
+    commands = parser.add_subparsers(dest="command")
+    write_parser = commands.add_parser("write", help="write a snapshot from schedule.db")
+    write_parser.add_argument("date", nargs="?", default=datetime.date.today().isoformat(), help="YYYY-MM-DD, today by default")
+    write_parser.add_argument("-o", "--output", help="directory to write to, snapshots/<date> by default")
+    count_parser = commands.add_parser("count", help="count trains, or calls with --calls, by columns such as atoc_code or hour")
+    count_parser.add_argument("snapshot", help="snapshot directory")
+    count_parser.add_argument("columns", nargs="+")
+    count_parser.add_argument("--calls", action="store_true", help="count calls at locations rather than trains")
+    count_parser.add_argument("--where", action="append", default=[], help="column=value, more than once to narrow further")
+    count_parser.add_argument("--limit", type=int, default=50)
+    platform_parser = commands.add_parser("platforms", help="how much of each hour each platform at a station is occupied")
+    platform_parser.add_argument("snapshot", help="snapshot directory")
+    platform_parser.add_argument("station", help="CRS or TIPLOC")
+    args = parser.parse_args()
+    if not args.command:
+        parser.error("a command is required: write, count or platforms")
+    require_numpy()
+
+    if args.command == "write":
+        try:
+            date = datetime.datetime.strptime(args.date, "%Y-%m-%d").date()
+        except ValueError:
+            sys.exit("Dates must be valid and in ISO 8601 format (YYYY-MM-DD)")
+        from main import app, calendar_dates, get_database
+        started = time.perf_counter()
+        with app.app_context():
+            counts = write(get_database(), date, date.isoformat() in calendar_dates(), args.output or os.path.join("snapshots", date.isoformat()))
+        print("%d schedules, %d locations written in %.2fs" % (counts + (time.perf_counter()-started,)))
+        return
+
+    snapshot = Snapshot(args.snapshot)
+    started = time.perf_counter()
+    if args.command == "count":
+        table = "locations" if args.calls else "schedules"
+        conditions = OrderedDict()
+        for condition in args.where:
+            name, equals, value = condition.partition("=")
+            if not equals:
+                count_parser.error("--where takes column=value, not %s" % condition)
+            conditions[name] = value
+        try:
+            for name in args.columns + list(conditions):
+                snapshot.column(table, name)
+        except (ValueError, KeyError):
+            sys.exit("Columns are %s, or hour" % ", ".join(snapshot.encodings[table]))
+        for name, value in conditions.items():
+            # Columns which aren't dictionary encoded hold numbers, which where() compares as such
+            if not snapshot.column(table, name)[1] and not value.lstrip("-").isdigit():
+                count_parser.error("%s holds numbers, so --where %s=%s can't be compared" % (name, name, value))
+        mask = snapshot.where(table, **conditions) if conditions else None
+        show_counts(snapshot.count(table, *args.columns, mask=mask), args.columns, args.limit)
+    else:
+        occupancy = snapshot.platform_occupancy(args.station)
+        if not occupancy:
+            sys.exit("No platforms recorded at %s" % args.station)
+        hours = len(next(iter(occupancy.values()))[0])
+        print("platform  most  " + " ".join("%02d" % (a % 24) for a in range(hours)))
+        for platform, (minutes, most) in occupancy.items():
+            print("%-8s  %4d  " % (platform, most) + " ".join("%2d" % a for a in minutes))
+    print("(%.3fs)" % (time.perf_counter()-started), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Writes a made up CIF extract of any size, for benchmarking and trying changes out without a real one.
+# The same arguments always give the same extract. Trains run back and forth along lines of real stations,
+# with passing points, unadvertised stops, STP overlays, cancellations and short term new schedules, and
+# some join, divide or form another train. --update writes an update extract to apply on top of it
+
+import argparse, datetime, gzip, random, sys
+
+import parse_cif
+
+# (offset, length, tag) of each field, laid out from the same specs parse_cif decodes with
+LAYOUTS = {a: [(offset, length, tag) for _, offset, length, tag in parse_cif.parse_spec(b)] for a,b in parse_cif.RECORDS.items()}
+
+FULL_REFERENCE, UPDATE_REFERENCE = "SYNTH1F", "SYNTH2U"
+
+def record(record_type, transaction=None, **fields):
+    # Untagged fields are left blank, apart from the transaction type which starts BS and AA records
+    out = [record_type]
+    for offset, length, tag in LAYOUTS[record_type]:
+        value = fields.get(tag)
+        if tag is None and offset == 2 and transaction:
+            value = transaction
+        out.append(("" if value is None else str(value)).ljust(length)[:length])
+    return "".join(out).ljust(80)
+
+def cif_date(date):
+    # Dates are written the way parse_cif reads them, YYMMDD
+    return date.strftime("%y%m%d")
+
+def cif_time(minutes, half=False):
+    return "%02d%02d%s" % ((minutes//60) % 24, minutes % 60, "H" if half else " ")
+
+def public_time(minutes):
+    return cif_time(minutes)[:4]
+
+class Network():
+    # Stations strung into lines which all pass through a few hubs, so trains meet and passengers can change
+    def __init__(self, stations, seed):
+        r = random.Random("%s-network" % seed)
+        candidates = sorted(a for a,b in parse_cif.TIPLOC.items() if b["crs"] and b["loc_source"] and len(a) <= 7)
+        self.stations = r.sample(candidates, min(stations, len(candidates)))
+        self.passing = r.sample(sorted(a for a,b in parse_cif.TIPLOC.items() if not b["crs"] and len(a) <= 7), 50)
+        self.hubs = self.stations[:max(2, len(self.stations)//40)]
+        others = self.stations[len(self.hubs):]
+        self.lines = []
+        for n in range(0, len(others), 12):
+            line = others[n:n+12]
+            line.insert(len(line)//2, self.hubs[(n//12) % len(self.hubs)])
+            self.lines.append(line)
+
+    def tiplocs(self):
+        return self.stations + self.passing
+
+def route(r, network):
+    # A run of at least two stations along one line, in either direction
+    line = r.choice(network.lines)
+    first = r.randrange(len(line)-1)
+    last = r.randrange(first+2, len(line)+1)
+    calls = line[first:last]
+    return calls[::-1] if r.random() < 0.5 else calls
+
+class Plan():
+    # Everything about one train that's needed to write it out, decided from the seed and its number alone so
+    # full and update extracts agree without either being read back
+    def __init__(self, network, seed, n, start, days):
+        r = random.Random("%s-%d" % (seed, n))
+        self.uid = "%s%05d" % ("CGLPWY"[n % 6], n)
+        self.start, self.end = start, start + datetime.timedelta(days=days-1)
+        self.days = r.choice(["1111100", "1111111", "1111110", "0000011", "1111000", "0000100"])
+        self.headcode = "%d%s%02d" % (r.choice([1, 2, 2, 2, 5]), r.choice("ABCDEFGHJKLMNPRSTUVWXY"), n % 100)
+        self.atoc = r.choice(["GW", "LM", "NT", "SE", "SN", "SW", "TP", "VT", "XC"])
+        self.power, self.timing_load, self.speed = r.choice([("EMU", "350", "110"), ("DMU", "S", "075"),
+            ("HST", "", "125"), ("DMU", "E", "090"), ("EMU", "390", "125"), ("E", "325", "100")])
+        self.calls = route(r, network)
+        self.departure = r.randrange(300, 1440+120)
+        self.passing = r.sample(network.passing, 3)
+        self.seed = r.random()
+
+    def locations(self, shift=0):
+        # [(tiploc, arrival, departure, pass, public, platform)], times in minutes past midnight and None where
+        # there isn't one
+        r = random.Random(self.seed)
+        minute, out = self.departure + shift, []
+        for n, tiploc in enumerate(self.calls):
+            if n:
+                if r.random() < 0.3:
+                    minute += r.randint(2, 6)
+                    out.append((r.choice(self.passing), None, None, minute, False, None))
+                minute += r.randint(2, 12)
+            last = n == len(self.calls)-1
+            dwell = 0 if n == 0 or last else r.choice([0, 1, 1, 2])
+            arrival = None if n == 0 else minute
+            departure = None if last else minute + dwell
+            # A few calls are set down or pick up only, and don't appear in public timetables
+            public = n == 0 or last or r.random() > 0.05
+            out.append((tiploc, arrival, departure, None, public, str(r.randint(1, 12))))
+            minute += dwell
+        return out
+
+    def schedule(self, stp, valid_from, valid_to, days=None, shift=0, transaction="N"):
+        yield record("BS", transaction, uid=self.uid, valid_from=cif_date(valid_from), valid_to=cif_date(valid_to),
+            days_running=days or self.days, status="P", category="OO", signalling_id=self.headcode,
+            business_sector="", power=self.power, timing_load=self.timing_load, speed=self.speed,
+            seating_class="B", reservations="S" if self.speed == "125" else "", stp=stp)
+        if stp == "C" or transaction == "D":
+            return
+        yield record("BX", atoc_code=self.atoc, applicable_timetable="Y")
+        locations = self.locations(shift)
+        for n, (tiploc, arrival, departure, passing, public, platform) in enumerate(locations):
+            if n == 0:
+                yield record("LO", tiploc=tiploc, departure=cif_time(departure, departure % 7 == 0),
+                    public_departure=public_time(departure), platform=platform, line="FL", activity="TB")
+            elif n == len(locations)-1:
+                yield record("LT", tiploc=tiploc, arrival=cif_time(arrival), public_arrival=public_time(arrival),
+                    platform=platform, activity="TF")
+            elif passing is not None:
+                yield record("LI", tiploc=tiploc, arrival="", departure="", **{"pass": cif_time(passing, True)},
+                    public_arrival="0000", public_departure="0000")
+            else:
+                yield record("LI", tiploc=tiploc, arrival=cif_time(arrival), departure=cif_time(departure, True),
+                    public_arrival=public_time(arrival) if public else "0000",
+                    public_departure=public_time(departure) if public else "0000",
+                    platform=platform, activity="T" if public else "D")
+
+    def full(self, n):
+        yield from self.schedule("P", self.start, self.end)
+        # Some run later for a few weeks, some not at all for a few days
+        if n % 10 == 3:
+            yield from self.schedule("O", self.start + datetime.timedelta(days=7), self.start + datetime.timedelta(days=27),
+                "1111111", shift=5)
+        if n % 23 == 5:
+            yield from self.schedule("C", self.start + datetime.timedelta(days=1), self.start + datetime.timedelta(days=3), "1111111")
+
+    def update(self, n):
+        if n % 40 == 11:
+            yield from self.schedule("P", self.start, self.end, transaction="D")
+        elif n % 15 == 7:
+            yield from self.schedule("P", self.start, self.end, shift=3, transaction="R")
+        if n % 30 == 13:
+            yield from self.schedule("O", self.start + datetime.timedelta(days=2), self.start + datetime.timedelta(days=4),
+                "1111111", shift=-4)
+
+class Short(Plan):
+    # An STP new schedule, a train which only runs for a week or so
+    def __init__(self, network, seed, n, start, days):
+        Plan.__init__(self, network, "%s-short" % seed, n, start, days)
+        self.uid = "Z%05d" % n
+        self.days = "1111111"
+
+    def full(self, n):
+        yield from self.schedule("N", self.start + datetime.timedelta(days=n % 5), self.start + datetime.timedelta(days=n % 5 + 6))
+
+def associate(plan, other, category):
+    # Lays other out so it really does join, divide from or follow on from plan, and returns where
+    locations = [a for a in plan.locations() if a[3] is None]
+    if category == "NP":
+        tiploc, _, _, _, _, _ = locations[-1]
+        other.calls = [tiploc] + [a for a in other.calls if a != tiploc]
+        other.departure = locations[-1][1] + 15
+    else:
+        where = locations[len(locations)//2] if len(locations) > 2 else locations[0]
+        tiploc = where[0]
+        calls = [a for a in other.calls if a != tiploc]
+        if category == "VV":
+            other.calls = [tiploc] + calls
+            other.departure = (where[2] or where[1]) + 2
+        else:
+            # Arriving three minutes before plan does
+            other.calls = calls + [tiploc]
+            other.departure = 0
+            other.departure = (where[1] or where[2]) - 3 - other.locations()[-1][1]
+    return tiploc
+
+def association(plan, other, category, tiploc, stp, valid_from, valid_to, transaction="N"):
+    return record("AA", transaction, uid_main=plan.uid, uid_assoc=other.uid, valid_from=cif_date(valid_from),
+        valid_to=cif_date(valid_to), assoc_days="1111111", category=category, date_indicator="S", tiploc=tiploc,
+        assoc_type="P", stp=stp)
+
+def plans(schedules, seed, start, days, stations):
+    network = Network(stations, seed)
+    trains = [Plan(network, seed, n, start, days) for n in range(schedules)]
+    associations = []
+    # Every twentieth train has another join it, divide from it, or form its next working
+    for n in range(0, schedules-1, 20):
+        category = ["VV", "JJ", "NP"][(n//20) % 3]
+        tiploc = associate(trains[n], trains[n+1], category)
+        # Running every day of its train's, so it applies whichever day is looked at
+        trains[n+1].days = trains[n].days
+        associations.append((trains[n], trains[n+1], category, tiploc))
+    shorts = [Short(network, seed, n, start, days) for n in range(schedules//50)]
+    return network, trains, shorts, associations
+
+def generate(schedules, seed=0, start=datetime.date(2018, 5, 20), days=200, stations=240, update=False):
+    # Yields the extract's records, without line endings
+    network, trains, shorts, associations = plans(schedules, seed, start, days, stations)
+    end = start + datetime.timedelta(days=days-1)
+    yield record("HD", mainframe_identity="TPS.USYNTH.PD%s" % cif_date(start), extract_date=cif_date(start),
+        extract_time="2200", current_reference=UPDATE_REFERENCE if update else FULL_REFERENCE,
+        previous_reference=FULL_REFERENCE if update else "", update_indicator="U" if update else "F", version="A",
+        user_date_start=cif_date(start), user_date_end=cif_date(end))
+
+    if update:
+        for n, (plan, other, category, tiploc) in enumerate(associations):
+            if n % 4 == 1:
+                yield association(plan, other, category, tiploc, "C", start + datetime.timedelta(days=5),
+                    start + datetime.timedelta(days=6))
+        for n, plan in enumerate(trains):
+            yield from plan.update(n)
+    else:
+        for n, tiploc in enumerate(network.tiplocs()):
+            entry = parse_cif.TIPLOC[tiploc]
+            yield record("TI", tiploc=tiploc, caps_ident="00", nlc="%06d" % (100000 + n),
+                nlc_check="A", description_tps=entry["name"].upper(), stanox=entry["stanox"] or "00000",
+                pomcp="0000", crs=entry["crs"], description_nlc=entry["name"][:16].upper())
+        for n, (plan, other, category, tiploc) in enumerate(associations):
+            yield association(plan, other, category, tiploc, "P", start, end)
+            # And some don't happen for a day or two
+            if n % 3 == 2:
+                yield association(plan, other, category, tiploc, "C", start + datetime.timedelta(days=1),
+                    start + datetime.timedelta(days=2))
+        for n, plan in enumerate(trains + shorts):
+            yield from plan.full(n)
+    yield record("ZZ")
+
+def write(path, schedules, seed=0, start=datetime.date(2018, 5, 20), days=200, stations=240, update=False):
+    # Returns the number of records written
+    count = 0
+    f = gzip.open(path, "wt") if path.endswith(".gz") else open(path, "w")
+    with f:
+        for line in generate(schedules, seed, start, days, stations, update):
+            f.write(line + "\n")
+            count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic CIF extract")
+    parser.add_argument("schedules", nargs="?", type=int, default=1000, help="trains in the extract")
+    parser.add_argument("-o", "--output", help="write to this file, gzipped if it ends .gz, rather than stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start", default="2018-05-20", help="first day of the extract, YYYY-MM-DD")
+    parser.add_argument("--days", type=int, default=200, help="days the extract covers")
+    parser.add_argument("--stations", type=int, default=240, help="stations the trains call at")
+    parser.add_argument("--update", action="store_true", help="write an update extract which follows the full one")
+    args = parser.parse_args()
+
+    try:
+        start = datetime.datetime.strptime(args.start, "%Y-%m-%d").date()
+    except ValueError:
+        sys.exit("Dates must be valid and in ISO 8601 format (YYYY-MM-DD)")
+
+    if args.output:
+        count = write(args.output, args.schedules, args.seed, start, args.days, args.stations, args.update)
+        print("%d records written to %s" % (count, args.output))
+    else:
+        for line in generate(args.schedules, args.seed, start, args.days, args.stations, args.update):
+            sys.stdout.write(line + "\n")
+
+if __name__ == "__main__":
+    main()
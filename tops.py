@@ -1,5 +1,5 @@
-import json
-from collections import OrderedDict
+import functools, json
+from collections import OrderedDict, defaultdict
 
 with open("images.json") as f:
     IMAGES = json.load(f)
@@ -63,14 +63,45 @@ TOPS_INFERENCES = [
     ((None, "DMU", None , "X", None),   ["158", "159"], "Express Sprinter", IMAGES["xn159"]),
     ]
 
+# Rule numbers by (ATOC, power type, timing load), with None where a rule doesn't care. Each schedule only has
+# to be checked against the rules under the eight keys it could match, rather than all of them
+INDEX = defaultdict(list)
+for n, entry in enumerate(TOPS_INFERENCES):
+    INDEX[(entry[0][0], entry[0][1], entry[0][3])].append(n)
+
+def key_for(current):
+    return (current["atoc_code"], current["power_type"], current["speed"],
+        current["timing_load"], current["seating_class"])
+
+def matches(key, rule):
+    return all([not y or x==y for x,y in zip(key, rule)])
+
+def scan(key):
+    # The first matching rule, checking every one in turn. lookup gives the same answers, quicker
+    for n, entry in enumerate(TOPS_INFERENCES):
+        if matches(key, entry[0]):
+            return n
+
+@functools.lru_cache(maxsize=1024)
+def lookup(key):
+    atoc, power, speed, timing_load, seating_class = key
+    candidates = set()
+    for a in {atoc, None}:
+        for p in {power, None}:
+            for t in {timing_load, None}:
+                candidates.update(INDEX.get((a, p, t), ()))
+    # Lowest rule number first, so earlier rules still take precedence
+    for n in sorted(candidates):
+        if matches(key, TOPS_INFERENCES[n][0]):
+            return n
+
+def result(n):
+    if n is None:
+        return OrderedDict(tops_inferred=None, tops_possible=[], tops_familiar=None, tops_image=None)
+    key,classes,familiar,image = (TOPS_INFERENCES[n] + (None,None))[:4]
+    return OrderedDict(tops_inferred="/".join(classes), tops_possible=classes, tops_familiar=familiar, tops_image=image)
+
 def infer(current):
-    nonetype = OrderedDict(tops_inferred=None, tops_possible=[], tops_familiar=None, tops_image=None)
     if not current:
-        return nonetype
-    tuple = (current["atoc_code"], current["power_type"], current["speed"],
-        current["timing_load"], current["seating_class"])
-    for entry in TOPS_INFERENCES:
-        key,classes,familiar,image = (entry + (None,None))[:4]
-        if all([not y or x==y for x,y in zip(tuple, key)]):
-            return OrderedDict(tops_inferred="/".join(classes), tops_possible=classes, tops_familiar=familiar, tops_image=image)
-    return nonetype
+        return result(None)
+    return result(lookup(key_for(current)))